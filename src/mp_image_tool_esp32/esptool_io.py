@@ -22,18 +22,21 @@ All esptool.py commands and output are logged to the DEBUG facility.
 
 from __future__ import annotations
 
+import codecs
 import io
+import os
 import re
 import shlex
 import sys
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from contextlib import ExitStack
 from subprocess import PIPE, CalledProcessError, Popen
 from tempfile import NamedTemporaryFile
 from typing import Any, Callable, Dict, Sequence
 
 import esptool
 import esptool.cmds
-import esptool.util
 from typing_extensions import Buffer
 
 from . import logger
@@ -45,11 +48,56 @@ log = logger.getLogger(__name__)
 BAUDRATES = (115200, 230400, 460800, 921600, 1500000, 2000000, 3000000)
 BAUDRATE = 921600  # Default baudrate for esptool.py
 BLOCKSIZE = B  # Block size for erasing/writing regions of the flash storage
+_BLOCKMASK = BLOCKSIZE - 1  # BLOCKSIZE is a power of 2
+
+
+# Regexps to match the chip type and flash size in `esptool.py flash_id` output
+CHIP_TYPE_REGEXP = re.compile(r"^Detecting chip type[. ]*(ESP.*)$", re.MULTILINE)
+FLASH_SIZE_REGEXP = re.compile(r"^Detected flash size: *([0-9]*)MB$", re.MULTILINE)
+
+# Data is handed to and from `esptool.py` subprocesses through temporary files.
+# Use a memory-backed filesystem for them where one is available (Linux).
+TEMPDIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+TEMP_PREFIX = "mp-image-tool-esp32-"
+
+# The (chip_name, flash_size) detected on each device by `ESPToolSubprocess`.
+# Saves running the slow `esptool.py flash_id` command each time a device is
+# re-opened in the same process.
+_detected_devices: dict[str, tuple[str, int]] = {}
 
 
 def set_baudrate(baud: int) -> int:
     """Set the baudrate for `esptool.py` to the highest value <= `baud`."""
-    return max(filter(lambda x: x <= baud, BAUDRATES))
+    return BAUDRATES[max(bisect_right(BAUDRATES, baud) - 1, 0)]  # Sorted tuple
+
+
+def set_low_latency(esp: esptool.ESPLoader) -> None:
+    """Set the `ASYNC_LOW_LATENCY` flag on the serial port to `esp` (Linux).
+    Many USB-serial adapters otherwise hold back short replies from the device
+    for up to 16ms, which adds up over the many command/reply exchanges."""
+    try:
+        esp._port.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError, OSError) as err:
+        log.debug(f"Serial port low latency mode not set: {err}")
+
+
+def change_baudrate(esp: esptool.ESPLoader, baud: int) -> int:
+    """Switch the connection to the stub flasher on `esp` to `baud` and check
+    it with a `flash_id` round trip. Returns the new baudrate.
+    Once the stub has switched baudrate, a failed connection can't be used to
+    try a lower rate, so raise `ValueError` naming the rate which failed."""
+    initial = esp._port.baudrate
+    if baud <= initial:
+        return initial
+    try:
+        esp.change_baud(baud)
+        esp.flash_id()
+    except (esptool.FatalError, OSError) as err:
+        raise ValueError(
+            f"Could not communicate with device at {baud} baud ({err}).\n"
+            "  Use the '--baud' option to select a lower baudrate."
+        ) from err
+    return baud
 
 
 class ESPTool(ABC):
@@ -62,7 +110,7 @@ class ESPTool(ABC):
     baud: int
     chip_name: str
     flash_size: int
-    esptool_args: str = "--after no_reset"
+    esptool_args: tuple[str, ...] = ("--after", "no_reset")
 
     @abstractmethod
     def __init__(self, port: str, baud: int) -> None:
@@ -70,8 +118,9 @@ class ESPTool(ABC):
         ...
 
     @abstractmethod
-    def esptool_cmd(self, command: str, *, size: int = 0) -> str:
-        """Execute an `esptool.py` command and return the output as a string."""
+    def esptool_cmd(self, command: str | Sequence[str], *, size: int = 0) -> str:
+        """Execute an `esptool.py` command and return the output as a string.
+        `command` may be a list of arguments or a string to be split."""
         ...
 
     @abstractmethod
@@ -79,6 +128,11 @@ class ESPTool(ABC):
         """Write `data` to the device flash storage at position `pos`."""
         ...
 
+    def write_flash_regions(self, regions: Sequence[tuple[int, Buffer]]) -> int:
+        """Write each `(pos, data)` region to the device flash storage.
+        Returns the total number of bytes written."""
+        return sum(self.write_flash(pos, data) for pos, data in regions)
+
     @abstractmethod
     def read_flash(self, pos: int, size: int) -> bytes:
         """Read `size` bytes from the device flash storage at position `pos`."""
@@ -89,6 +143,11 @@ class ESPTool(ABC):
         """Erase a region of the device flash storage starting at `pos`."""
         ...
 
+    def flash_md5(self, pos: int, size: int) -> bytes | None:
+        """Return the MD5 digest of `size` bytes of flash storage at `pos`,
+        calculated on the device. Returns `None` if that is not supported."""
+        return None  # Reading the flash to calculate the digest costs too much
+
     @abstractmethod
     def hard_reset(self) -> None:
         """Perform a hard reset of the device using the RTS pin."""
@@ -100,21 +159,24 @@ class ESPTool(ABC):
         ...
 
 
-def check_alignment(func: Callable[..., Any]) -> Callable[..., Any]:
-    """Raise a ValueError if any of the arguments are integers that are not
-    aligned to the `BLOCKSIZE`."""
+def check_alignment(name: str, *values: int) -> None:
+    """Raise a ValueError if any of `values` are not aligned to the
+    `BLOCKSIZE`."""
+    for value in values:
+        if value & _BLOCKMASK:
+            raise ValueError(
+                f"{name}: {value:#x} is not aligned to "
+                f"blocksize ({BLOCKSIZE:#x} bytes)."
+            )
 
-    def inner(self: Any, *args: Sequence[Any]) -> Callable[..., Any]:
-        for arg in args:
-            if isinstance(arg, int):
-                if arg % BLOCKSIZE:
-                    raise ValueError(
-                        f"{func.__name__}: {arg:#x} is not aligned to "
-                        f"blocksize ({BLOCKSIZE:#x} bytes)."
-                    )
-        return func(self, *args)  # type: ignore
 
-    return inner
+def as_bytes(data: Buffer) -> bytes:
+    """Return the contents of `data` as a `bytes` object. If `data` is (or is a
+    view of the whole of) a `bytes` object, that object is returned uncopied."""
+    mv = memoryview(data)
+    if isinstance(mv.obj, bytes) and mv.nbytes == len(mv.obj):
+        return mv.obj
+    return mv.tobytes()
 
 
 class ESPToolSubprocess(ESPTool):
@@ -124,16 +186,24 @@ class ESPToolSubprocess(ESPTool):
     def __init__(self, port: str, baud: int = 0):
         self.port = port
         self.baud = set_baudrate(baud or BAUDRATE)
-        output = self.esptool_cmd("flash_id")
-        match = re.search(r"^Detecting chip type[. ]*(ESP.*)$", output, re.MULTILINE)
-        self.chip_name = match.group(1).lower().replace("-", "") if match else ""
-        match = re.search(r"^Detected flash size: *([0-9]*)MB$", output, re.MULTILINE)
-        self.flash_size = int(match.group(1)) * MB if match else 0
+        # Symlinks (eg. /dev/serial/by-id/...) to the same device share an entry
+        device = os.path.realpath(port)
+        if device not in _detected_devices:
+            _detected_devices[device] = self.detect_device()
+        self.chip_name, self.flash_size = _detected_devices[device]
         if self.chip_name:
-            self.esptool_args = " ".join((self.esptool_args, "--chip", self.chip_name))
+            self.esptool_args = (*self.esptool_args, "--chip", self.chip_name)
         log.debug(f"Detected {self.chip_name} with flash size {self.flash_size/MB}MB.")
 
-    def esptool_run(self, cmd: str) -> None:
+    def detect_device(self) -> tuple[str, int]:
+        """Run `esptool.py flash_id` and return the chip name and flash size."""
+        output = self.esptool_cmd("flash_id")
+        match = CHIP_TYPE_REGEXP.search(output)
+        chip_name = match.group(1).lower().replace("-", "") if match else ""
+        match = FLASH_SIZE_REGEXP.search(output)
+        return chip_name, int(match.group(1)) * MB if match else 0
+
+    def esptool_run(self, args: list[str]) -> None:
         """Run an esptool command in a subprocess and echo output to sys.stdout."""
         # subprocess.run() will not redirect the output if we have redirected
         # sys.stdout, so we use Popen() to capture the esptool read_flash and
@@ -141,47 +211,66 @@ class ESPToolSubprocess(ESPTool):
         # (which may then be redirected for capture).
         #
         # Progress messages are not terminated with a newline, so we can't use line
-        # buffered output (bufsize=1) to get progress messages from esptool.py.
-        # Either use unbuffered (=0) or a small buffer size for responsiveness.
-        cmd = f"{sys.executable} -m esptool {cmd}"  # python -m esptool ...
-        p = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE, text=True, bufsize=20)
+        # buffered output to get progress messages from esptool.py. Echo whatever
+        # output is available (up to 4KB at a time) as soon as it arrives.
+        argv = [sys.executable, "-m", "esptool", *args]  # python -m esptool ...
+        p = Popen(argv, stdout=PIPE, stderr=PIPE)
+        decode = codecs.getincrementaldecoder("utf-8")(errors="replace").decode
         if p.stdout:  # Read stdout first to capture progress messages
-            while s := p.stdout.read(1):  # Cant use readline() to read messages
-                sys.stdout.write(s)
+            fd = p.stdout.fileno()
+            while b := os.read(fd, 4096):  # Cant use readline() to read messages
+                sys.stdout.write(decode(b))
         if p.stderr:
-            sys.stderr.write(p.stderr.read())
+            sys.stderr.write(p.stderr.read().decode(errors="replace"))
         if err := p.wait():
-            raise CalledProcessError(err, cmd)
-
-    def esptool_cmd(self, command: str, *, size: int = 0) -> str:
-        cmd = f"{self.esptool_args} --baud {self.baud} --port {self.port} {command}"
-        name = command.split()[0]  # Get the command name for the progress bar
+            raise CalledProcessError(err, argv)
+
+    def esptool_cmd(self, command: str | Sequence[str], *, size: int = 0) -> str:
+        # Build the argument list directly: don't split the port or file names
+        command = shlex.split(command) if isinstance(command, str) else command
+        args = [
+            *self.esptool_args,
+            *("--baud", str(self.baud), "--port", self.port),
+            *command,
+        ]
+        name = command[0]  # Get the command name for the progress bar
         name = " ".join(s.capitalize() for s in name.split("_", 1))
-        with EsptoolMonitor(size, name=name) as monitor:
-            self.esptool_run(cmd)
+        # Only keep the output of commands which are not flash transfers
+        with EsptoolMonitor(size, name=name, keep_output=not size) as monitor:
+            self.esptool_run(args)
         return monitor.output
 
-    @check_alignment
     def write_flash(self, pos: int, data: Buffer) -> int:
-        data = memoryview(data)
-        with NamedTemporaryFile("w+b", prefix="mp-image-tool-esp32-") as f:
-            f.write(data)
-            f.flush()
-            self.esptool_cmd(f"write_flash {pos:#x} {f.name}", size=len(data))
-            return len(data)
+        return self.write_flash_regions(((pos, data),))
+
+    def write_flash_regions(self, regions: Sequence[tuple[int, Buffer]]) -> int:
+        # Write all the regions with a single `esptool.py write_flash` command
+        with ExitStack() as stack:
+            size, args = 0, ["write_flash"]
+            for pos, data in regions:
+                check_alignment("write_flash", pos)
+                f = stack.enter_context(
+                    NamedTemporaryFile("w+b", prefix=TEMP_PREFIX, dir=TEMPDIR)
+                )
+                size += f.write(data)
+                f.flush()
+                args += (f"{pos:#x}", f.name)
+            self.esptool_cmd(args, size=size)
+        return size
 
     def read_flash(self, pos: int, size: int) -> bytes:
-        with NamedTemporaryFile("w+b", prefix="mp-image-tool-esp32-") as f:
-            self.esptool_cmd(f"read_flash {pos:#x} {size:#x} {f.name}", size=size)
+        with NamedTemporaryFile("w+b", prefix=TEMP_PREFIX, dir=TEMPDIR) as f:
+            args = ["read_flash", f"{pos:#x}", f"{size:#x}", f.name]
+            self.esptool_cmd(args, size=size)
             f.seek(0)
             return f.read()
 
-    @check_alignment
     def erase_flash(self, pos: int, size: int) -> None:
+        check_alignment("erase_flash", pos, size)
         self.esptool_cmd(f"erase_region {pos:#x} {size:#x}")
 
     def hard_reset(self) -> None:
-        if "--after no_reset" in self.esptool_args:
+        if any(arg.startswith("no_reset") for arg in self.esptool_args):
             self.esptool_cmd("--after hard_reset chip_id")
 
     def close(self) -> None:
@@ -190,17 +279,38 @@ class ESPToolSubprocess(ESPTool):
 
 class ESPToolModuleMain(ESPToolSubprocess):
     esp_maybe: esptool.ESPLoader | None
+    # The connection passed to `esptool.main()` is already running the stub
+    # flasher: `--no-stub` stops esptool uploading the stub again on every
+    # command and `no_reset_stub` leaves the stub running after each command.
+    esptool_args: tuple[str, ...] = ("--after", "no_reset_stub", "--no-stub")
 
     """An ESPTool class which calls `esptool.main()` from the esptool module.
     Overrides the esptool_run() method to run the esptool commands using
-    `esptool.main()` in this python process (instead of a subprocess)."""
+    `esptool.main()` in this python process (instead of a subprocess).
+
+    Connects to the device and loads the stub flasher once, and passes the
+    connection to `esptool.main()` for every command."""
 
     def __init__(self, port: str, baud: int = 0):
-        self.esp_maybe = None
+        with EsptoolMonitor(name="detect_chip"):  # Suppress esptool output
+            esp = esptool.cmds.detect_chip(port)
+            set_low_latency(esp)
+            self.esp_maybe = esp = esp.run_stub()
+            baud = change_baudrate(esp, set_baudrate(baud or BAUDRATE))
         super().__init__(port, baud)
 
-    def esptool_run(self, cmd: str) -> None:
-        esptool.main(shlex.split(cmd), self.esp_maybe)
+    def esptool_run(self, args: list[str]) -> None:
+        esptool.main(args, self.esp_maybe)
+
+    def flash_md5(self, pos: int, size: int) -> bytes | None:
+        if not self.esp_maybe:
+            return None
+        # The MD5 is calculated on the device: only the digest is transferred
+        return bytes.fromhex(self.esp_maybe.flash_md5sum(pos, size))
+
+    def close(self) -> None:
+        if self.esp_maybe:
+            self.esp_maybe._port.close()
 
 
 class ESPToolModuleDirect(ESPToolModuleMain):
@@ -221,24 +331,28 @@ class ESPToolModuleDirect(ESPToolModuleMain):
         self.baud = set_baudrate(baud or BAUDRATE)
         with EsptoolMonitor(name="detect_chip"):  # Suppress esptool output
             esp = esptool.cmds.detect_chip(port)
+            set_low_latency(esp)
             esp = esp.run_stub()  # Load the stub flasher for better performance
+            self.baud = change_baudrate(esp, self.baud)
 
         self.esp = esp
         self.esp_maybe = esp
-        self.esptool_args = "--after no_reset_stub --no-stub"
-        # Initialize the device and detect the flash size
-        self.esptool_cmd("flash_id")
-        log.debug(f"Connected to ESP32 device on {port} at {baud} baud.")
+        # Initialize the device and detect the flash size from the output
+        output = self.esptool_cmd("flash_id")
+        log.debug(f"Connected to ESP32 device on {port} at {self.baud} baud.")
         self.chip_name = esp.CHIP_NAME.lower().replace("-", "")
-        size_str = esptool.cmds.detect_flash_size(esp) or ""
-        log.debug(f"Detected flash size: {size_str}")
-        self.flash_size = esptool.util.flash_size_bytes(size_str) or 0
-        log.debug(f"Detected {self.chip_name} with flash size {size_str}.")
-        if not size_str or not self.flash_size:
+        match = FLASH_SIZE_REGEXP.search(output)
+        self.flash_size = int(match.group(1)) * MB if match else 0
+        log.debug(
+            f"Detected {self.chip_name} with flash size {self.flash_size / MB}MB."
+        )
+        if not self.flash_size:
             raise ValueError("Could not detect flash size.")
 
-    @check_alignment
     def write_flash(self, pos: int, data: Buffer) -> int:
+        return self.write_flash_regions(((pos, data),))
+
+    def write_flash_regions(self, regions: Sequence[tuple[int, Buffer]]) -> int:
         # esptool cmds require an argparse-like args object. We use the Dictargs
         # class to mockup the required arguments for `write_flash()`
         # Unfortunately esptool doesn't provide a lower-level API for writing
@@ -246,14 +360,21 @@ class ESPToolModuleDirect(ESPToolModuleMain):
         class Dictargs(Dict[str, Any]):
             __getattr__: Callable[[str], Any] = dict.get  # type: ignore
 
+        size, files = 0, []
+        for pos, data in regions:
+            check_alignment("write_flash", pos)
+            # esptool reads the whole file into a `bytes` object. `io.BytesIO()`
+            # shares the buffer of a `bytes` object, so `data` is not copied.
+            data = as_bytes(data)  # Only copies views of part of an object
+            files.append((pos, io.BytesIO(data)))
+            size += len(data)
         args = Dictargs(
             flash_mode="keep",
             flash_size="keep",
             flash_frequency="keep",
             compress=True,
-            addr_filename=((pos, io.BytesIO(data)),),
+            addr_filename=tuple(files),  # Write all the regions in one operation
         )
-        size = len(memoryview(data))
         with EsptoolMonitor(size, name="Write Flash"):  # Show a progress bar
             esptool.cmds.write_flash(self.esp, args)
         return size
@@ -262,8 +383,8 @@ class ESPToolModuleDirect(ESPToolModuleMain):
         with ProgressBar(total=size, name="Read Flash") as pbar:  # Show a progress bar
             return self.esp.read_flash(pos, size, pbar.update)
 
-    @check_alignment
     def erase_flash(self, pos: int, size: int) -> None:
+        check_alignment("erase_flash", pos, size)
         self.esp.erase_region(pos, size)
 
     def hard_reset(self) -> None:
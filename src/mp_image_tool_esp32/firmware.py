@@ -16,9 +16,16 @@ firmware files.
 
 from __future__ import annotations
 
+import bisect
+import hashlib
+import os
+from typing import Iterable, Iterator
+
+from typing_extensions import Buffer
+
 from . import logger
 from .argtypes import MB, B
-from .firmware_fileio import FirmwareDeviceIO, FirmwareFileIO, Partition
+from .firmware_fileio import ERASED_BLOCK, FirmwareDeviceIO, FirmwareFileIO, Partition
 from .image_header import ImageHeader
 from .partition_table import PartitionEntry, PartitionTable
 
@@ -32,8 +39,11 @@ PARTITIONTABLE_NAME = "partition_table"
 
 
 def is_device(filename: str) -> bool:
-    """Return `True` if `filename` is a serial device, else `False`."""
-    return filename.startswith("/dev/") or filename.startswith("COM")
+    """Return `True` if `filename` is a serial device (eg. `/dev/ttyUSB0` or
+    `COM3`), else `False`. Windows device names are not case sensitive."""
+    return filename.startswith("/dev/") or (
+        filename[:3].upper() == "COM" and filename[3:].isdigit()
+    )
 
 
 class Firmware:
@@ -63,6 +73,7 @@ class Firmware:
         check: bool = True,
     ) -> None:
         self.filename = filename
+        self.is_device = is_device(filename)
         self.file = (
             FirmwareDeviceIO(  # type: ignore
                 filename,
@@ -71,10 +82,9 @@ class Firmware:
                 reset_on_close=reset_on_close,
                 check=check,
             )
-            if is_device(filename)
+            if self.is_device
             else FirmwareFileIO(filename)
         )
-        self.is_device = isinstance(self.file, FirmwareDeviceIO)
         self.header = self.file.header
         self.bootloader = self.file.bootloader
         self.table = self._load_table()
@@ -107,51 +117,108 @@ class Firmware:
         """Return a `Partition` object for the partition `part`."""
         return Partition(self._get_part(part), self.file)  # type: ignore
 
-    def check_app_image_header(self, data: bytes, name: str) -> bool:
-        """Check that `data` is a valid app image for this device/firmware."""
+    def check_app_image_header(self, data: Buffer, name: str) -> ImageHeader | None:
+        """Check that `data` starts with a valid app image header for this
+        device/firmware. Only the header bytes at the start of `data` are read.
+        Returns the validated `ImageHeader` or `None` if the check fails."""
         try:
             header = ImageHeader.from_bytes(data)
             header.validate()
         except ValueError:
-            return False
+            return None
         if not header.chip_name:  # `data` is not an app image
-            return False
+            return None
         if header.chip_name != self.header.chip_name:
             log.warning(
                 f"'{name}': App image chip type ({header.chip_name}) "
                 f"does not match bootloader ({self.header.chip_name})."
             )
-            return False
+            return None
         if name == BOOTLOADER_NAME and header.flash_size != self.header.flash_size:
             log.warning(
                 f"'{name}': image flash size ({header.flash_size}) "
                 f"does not match bootloader ({self.header.flash_size})."
             )
-        return True
+        return header
 
     def trimblocks(self, data: bytes, blocksize: int = 0) -> bytes:
         """Trim trailing 0xff bytes from `data` to the nearest block
         boundary."""
         blocksize = blocksize or self.BLOCKSIZE
-        n = len(data)
-        while n > 0 and data[n - 1] == 0xFF:
-            n -= 1
+        n = len(data.rstrip(b"\xff"))
         return data[: min(len(data), ((n + blocksize - 1) // blocksize) * blocksize)]
 
+    def save_part_image(
+        self, part: PartitionEntry | str, output: str, blocksize: int = 0
+    ) -> int:
+        """Read the contents of a partition and write it to a file.
+        The partition is copied in chunks. If `blocksize` is non-zero, trailing
+        0xff bytes are trimmed (to a `blocksize` boundary) from the end of the
+        file."""
+        total, end = 0, 0  # Bytes written and end of the last non-0xff data
+        with self.partition(part) as p, open(output, "wb") as fout:
+            while data := p.read(self.file.IO_CHUNK):
+                if n := len(data.rstrip(b"\xff")):
+                    end = total + n
+                total += fout.write(data)
+            size = total
+            if blocksize:
+                size = min(total, (end + blocksize - 1) // blocksize * blocksize)
+            fout.truncate(size)
+            return size
+
     def save_app_image(self, output: str) -> int:
-        """Read the first app image from the device and write it to a file."""
-        with self.partition(self.table.app_part) as part:
-            with open(output, "wb") as fout:
-                return fout.write(self.trimblocks(part.read(), 16))
+        """Read the first app image from the device and write it to a file.
+        Trailing 0xff bytes are trimmed (to a 16-byte boundary) from the end of
+        the file."""
+        return self.save_part_image(self.table.app_part, output, 16)
+
+    def load_part_image(
+        self, part: PartitionEntry | str, filename: str, check_app: bool = True
+    ) -> int:
+        """Write the contents of `filename` into a partition and erase the rest
+        of the partition. The file is copied in chunks, rather than read into
+        memory all at once. If `check_app` is `True`, the file must start with
+        a valid app image header when writing to an app partition."""
+        total = 0
+        with self.partition(part) as p, open(filename, "rb") as fin:
+            name, size = p.part.name, os.fstat(fin.fileno()).st_size
+            if size > p.part.size:
+                raise ValueError(
+                    f"Partition '{name}': '{filename}' is too large ({size:#x})."
+                )
+            data = fin.read(self.file.IO_CHUNK)
+            if (
+                check_app
+                and p.part.type_name == "app"
+                and self.check_app_image_header(data, name) is None
+            ):
+                raise ValueError(f"Attempt to write invalid app image to '{name}'.")
+            while data:
+                total += p.write(data)
+                data = fin.read(self.file.IO_CHUNK)
+            p.truncate()
+        return total
+
+    def iter_firmware(self, chunksize: int = 0) -> Iterator[bytes]:
+        """Yield the entire firmware from this image in chunks of `chunksize`
+        bytes (default: `IO_CHUNK` of this image)."""
+        f, pos = self.file, self.bootloader  # Firmware files start at the bootloader
+        chunksize = chunksize or f.IO_CHUNK
+        while pos < self.size:
+            if not (data := f.pread(pos, min(chunksize, self.size - pos))):
+                break
+            pos += len(data)
+            yield data
 
     def read_firmware(self) -> bytes:
         """Return the entire firmware from this image as `bytes"""
-        f = self.file
-        f.seek(self.bootloader)  # Firmware files start at the bootloader
-        return self.trimblocks(f.read(), 16)  # Trim trailing 0xff bytes
+        return self.trimblocks(b"".join(self.iter_firmware()), 16)
 
     def write_firmware(self, image: Firmware) -> int:
-        """Write firmware from `image` into this image."""
+        """Write firmware from `image` into this image.
+        The firmware is copied in chunks. Trailing 0xff bytes in each chunk are
+        not written: they are erased only if more data follows them."""
         if not isinstance(self.file, FirmwareDeviceIO):
             raise ValueError("Must flash firmware to a device.")
         src, dst = image.header, self.header
@@ -162,11 +229,22 @@ class Firmware:
             )
         f = self.file
         f.seek(self.bootloader)
-        data = image.read_firmware()
-        pad = self.BLOCKSIZE - (((len(data) - 1) % self.BLOCKSIZE) + 1)
-        size = f.write(data + b"\xff" * pad)
-        if size < len(data) + pad:
-            raise ValueError(f"Failed to write {len(data)} bytes to '{self.filename}'.")
+        size, skipped = 0, 0  # Bytes written and trailing 0xff bytes not written
+        # Each device write is an esptool command: use the device chunk size
+        for chunk in image.iter_firmware(f.IO_CHUNK):
+            data = self.trimblocks(chunk)
+            if not data:
+                skipped += len(chunk)
+                continue
+            if skipped:
+                f.erase(skipped)
+            pad = -len(data) % self.BLOCKSIZE  # Pad to a block boundary
+            if f.writev((data, ERASED_BLOCK[:pad])) < len(data) + pad:
+                raise ValueError(
+                    f"Failed to write {len(data)} bytes to '{self.filename}'."
+                )
+            size += skipped + len(data) + pad
+            skipped = len(chunk) - len(data)
         if p := next((p for p in image.table if p.offset + p.size >= size), None):
             log.action(f"Erasing remainder of partition '{p.name}'...")
             f.erase(p.offset + p.size - size)
@@ -176,44 +254,55 @@ class Firmware:
         self, new_table: PartitionTable, check_hash: bool = False
     ) -> None:
         """Check that the app partitions contain valid app image signatures."""
-        app_parts = [self._get_part(BOOTLOADER_NAME)] + [
-            p for p in new_table if p.type_name == "app" and p.offset < self.size
-        ]
+        app_parts = sorted(
+            [self._get_part(BOOTLOADER_NAME)]
+            + [p for p in new_table if p.type_name == "app" and p.offset < self.size],
+            key=lambda p: p.offset,
+        )
+        apps: list[tuple[PartitionEntry, ImageHeader]] = []
         for partentry in app_parts:
             # Check there is an app header at the start of the partition
             name = partentry.name
             with self.partition(partentry) as part:
-                data = part.read(self.BLOCKSIZE)
-                if not self.check_app_image_header(data, name):
-                    log.warning(f"Partition '{name}': App image signature not found.")
-                    continue
-                log.info(f"Partition '{name}': App image signature found.")
-                if not check_hash:
-                    continue
-                data += part.read()  # Read the rest of the partition
-            header = ImageHeader.from_bytes(data)
-            size, calc_sha, stored_sha = header.check_image_hash(data)
-            size += len(stored_sha)  # Include the stored hash in the size
-            sha, stored = calc_sha.hex(), stored_sha.hex()
-            log.debug(f"{name}: {size=}\n       {sha=}\n    {stored=})")
-            if sha != stored:
-                log.warning(
-                    f"Partition '{name}': Hash mismatch ({size=} {sha=} {stored=})"
-                )
-            else:
-                log.info(f"Partition '{name}': Hash confirmed ({size=}).")
+                header = self.check_app_image_header(part.read(self.BLOCKSIZE), name)
+            if header is None:
+                log.warning(f"Partition '{name}': App image signature not found.")
+                continue
+            log.info(f"Partition '{name}': App image signature found.")
+            apps.append((partentry, header))
+        if not check_hash:
+            return
+        for partentry, header in apps:
+            with self.partition(partentry) as part:
+                # Reading stops at the end of the image (and the stored hash)
+                chunks = iter(lambda: part.read(self.file.IO_CHUNK), b"")
+                self.check_image_hash(header, chunks, partentry.name)
+
+    def check_image_hash(
+        self, header: ImageHeader, chunks: Iterable[bytes], name: str
+    ) -> None:
+        """Check and log the sha256 hash of the app image read from `chunks`."""
+        size, calc_sha, stored_sha = header.check_image_hash_stream(chunks)
+        size += len(stored_sha)  # Include the stored hash in the size
+        sha, stored = calc_sha.hex(), stored_sha.hex()
+        log.debug(f"{name}: {size=}\n       {sha=}\n    {stored=})")
+        if sha != stored:
+            log.warning(f"Partition '{name}': Hash mismatch ({size=} {sha=} {stored=})")
+        else:
+            log.info(f"Partition '{name}': Hash confirmed ({size=}).")
 
     def check_data_partitions(self, new_table: PartitionTable) -> None:
         """Erase any data partitions in `new_table` which have been moved or resized."""
-        old_table = self.table
-        oldparts, newparts = (p for p in old_table or (None,)), (p for p in new_table)
-        oldp = next(oldparts)
-        for newp in newparts:
-            while oldp and oldp.offset < newp.offset:
-                oldp = next(oldparts, None)
-            if not oldp:
+        old_table, max_offset = self.table, self.size
+        old_offsets = [p.offset for p in old_table]  # Old table is sorted by offset
+        erase: list[tuple[int, int]] = []  # (offset, size) of regions to erase
+        for newp in new_table:
+            # Find the first old partition at or after the new partition offset
+            i = bisect.bisect_left(old_offsets, newp.offset)
+            if i == len(old_table):
                 continue
-            if newp.type_name == "data" and newp != oldp and newp.offset < self.size:
+            oldp = old_table[i]
+            if newp.type_name == "data" and newp != oldp and newp.offset < max_offset:
                 if (
                     newp.subtype_name == "fat"
                     and newp.type == oldp.type
@@ -228,17 +317,43 @@ class Firmware:
                     )
                 else:
                     log.action(f"Erasing data partition: {newp.name}...")
-                    with self.partition(newp) as part:
-                        part.erase(min(newp.size, 4 * self.BLOCKSIZE))
+                    erase.append((newp.offset, min(newp.size, 4 * self.BLOCKSIZE)))
+        self.erase_regions(erase)
+
+    def erase_regions(self, regions: Iterable[tuple[int, int]]) -> None:
+        """Erase a collection of `(offset, size)` regions of the flash storage.
+        Adjacent or overlapping regions are merged and erased in one operation."""
+        merged: list[tuple[int, int]] = []
+        for offset, size in sorted(regions):
+            if merged and offset <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], offset + size))
+            else:
+                merged.append((offset, offset + size))
+        for start, end in merged:
+            self.file.seek(start)
+            self.file.erase(end - start)
 
     def update_bootloader(self) -> None:
         """Update the bootloader header and hash, if it has changed."""
+        blocksize = self.BLOCKSIZE
         with self.partition(BOOTLOADER_NAME) as part:
-            data = part.read()  # Read the whole bootloader
-            data, _new_hash_offset = self.header.update_image(data)
-            part.seek(0)
-            part.write(data)  # Write the block with the new header
-            part.truncate()  # Erase the rest of the bootloader fake partition
+            # The header is in the first block, but need the whole image to
+            # update the hash. `update_image()` returns an updated copy of `data`
+            data = part.read(None if self.header.hash_appended == 1 else blocksize)
+            image, hash_offset = self.header.update_image(data)
+            if image == data:
+                log.debug("Bootloader is unchanged: skipping update.")
+                return
+            if image[:blocksize] != data[:blocksize]:
+                part.seek(0)
+                part.write(image[:blocksize])  # Write the block with the new header
+            if hash_offset:  # Write the block(s) holding the new hash
+                start = max(hash_offset - hash_offset % blocksize, blocksize)
+                end = hash_offset + hashlib.sha256().digest_size
+                end = min((end + blocksize - 1) // blocksize * blocksize, len(image))
+                if end > start and image[start:end] != data[start:end]:
+                    part.seek(start)
+                    part.write(image[start:end])
 
     def write_table(self, table: PartitionTable) -> None:
         """Write a new `PartitionTable` to the flash storage or firmware file."""
@@ -259,4 +374,5 @@ class Firmware:
         self.write_table(table)
         self.check_app_partitions(table)  # Check app parts for valid app signatures
         self.check_data_partitions(table)  # Erase data partitions which have changed
-        self.table = self._load_table()
+        # Load the new table from memory, rather than reading it back from flash
+        self.table = PartitionTable.from_bytes(table.to_bytes(), self.header.flash_size)
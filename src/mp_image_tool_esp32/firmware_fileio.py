@@ -14,24 +14,32 @@ serial-attached ESP32 devices. These classes also provide an additional method:
 
 from __future__ import annotations
 
+import hashlib
 import io
 import os
-from collections import defaultdict
-from typing import BinaryIO
+from collections import OrderedDict
+from typing import TYPE_CHECKING, BinaryIO, Sequence
 
 from typing_extensions import Buffer
 
 from . import logger
-from .argtypes import MB
-from .esptool_io import BLOCKSIZE, ESPTool, get_esptool
+from .argtypes import MB, B
 from .image_header import ImageHeader
 from .partition_table import PartitionEntry, PartitionError
 
+if TYPE_CHECKING:
+    from .esptool_io import ESPTool
+
 log = logger.getLogger(__name__)
 
+BLOCKSIZE = B  # Block size for erasing/writing regions of the flash storage
+
 # Bootloader offsets for esp32 devices, indexed by chip name
 # Offset is zero for all devices except esp32 and esp32s2
-BOOTLOADER_OFFSET = defaultdict(int, esp32=0x1_000, esp32s2=0x1_000)
+BOOTLOADER_OFFSET: dict[str, int] = {"esp32": 0x1_000, "esp32s2": 0x1_000}
+
+# A block of erased flash storage: slices are used to pad writes to block size
+ERASED_BLOCK = memoryview(b"\xff" * BLOCKSIZE)
 
 
 class FirmwareFileIO(io.BufferedRandom):
@@ -46,13 +54,15 @@ class FirmwareFileIO(io.BufferedRandom):
     bootloader: int
     size: int
     BLOCKSIZE: int = BLOCKSIZE
+    IO_CHUNK: int = 16 * BLOCKSIZE  # Size of reads/writes when copying data
+    IOV_MAX: int = 1024  # Max number of buffers in a single `os.pwritev()` call
 
     def __init__(self, name: str):
         # Detach the raw base file from `file` and attach it to this object
         f = open(name, "r+b")
         self.header = ImageHeader.from_file(f)
         self.header.validate()  # Raise an exception for invalid headers
-        self.bootloader = BOOTLOADER_OFFSET[self.header.chip_name]
+        self.bootloader = BOOTLOADER_OFFSET.get(self.header.chip_name, 0)
         self.size = f.seek(0, 2) + self.bootloader
         f.seek(0)  # Reset file position
         super().__init__(f.detach())
@@ -69,12 +79,50 @@ class FirmwareFileIO(io.BufferedRandom):
     def tell(self) -> int:
         return super().tell() + self.bootloader
 
+    def pread(self, pos: int, size: int) -> bytes:
+        """Read `size` bytes from `pos` without moving the file position.
+        Uses a single `os.pread()` call where it is available (not Windows)."""
+        if pos < self.bootloader:
+            raise ValueError(f"Attempt to read before offset ({self.bootloader:#x}).")
+        if hasattr(os, "pread"):
+            self.flush()  # Make sure buffered writes are visible to `os.pread()`
+            return os.pread(self.fileno(), size, pos - self.bootloader)
+        current = self.tell()
+        self.seek(pos)
+        data = self.read(size)
+        self.seek(current)
+        return data
+
+    def writev(self, buffers: Sequence[Buffer]) -> int:
+        """Write a sequence of buffers, without joining them together.
+        Uses a single `os.pwritev()` call where it is available (not Windows)."""
+        if not hasattr(os, "pwritev"):
+            return sum(self.write(b) for b in buffers)
+        self.flush()  # Write out any buffered data before using the raw file
+        pos = self.tell()
+        size = os.pwritev(self.fileno(), buffers, pos - self.bootloader)
+        self.seek(pos + size)
+        return size
+
     # Add an `erase` method
     def erase(self, size: int) -> None:
         """Erase a region of the device flash storage.
         Size should be a multiple of `0x1000 (4096)`, the device block size"""
-        log.debug(f"Erasing {size:#x} bytes at position {self.tell():#x}...")
-        self.write(b"\xff" * size)
+        pos = self.tell()
+        log.debug(f"Erasing {size:#x} bytes at position {pos:#x}...")
+        blocks, remainder = divmod(size, self.BLOCKSIZE)
+        if hasattr(os, "pwritev"):  # Write many erased blocks per system call
+            self.flush()  # Write out any buffered data before using the raw file
+            fd, offset = self.fileno(), pos - self.bootloader
+            while blocks:
+                n = min(blocks, self.IOV_MAX)
+                if os.pwritev(fd, [ERASED_BLOCK] * n, offset) != n * self.BLOCKSIZE:
+                    raise ValueError(f"Failed to erase {size:#x} bytes at {pos:#x}.")
+                blocks, offset = blocks - n, offset + n * self.BLOCKSIZE
+            self.seek(pos + size - remainder)
+        for _ in range(blocks):  # Reuse the erased block: don't allocate `size`
+            self.write(ERASED_BLOCK)
+        self.write(ERASED_BLOCK[:remainder])
 
 
 class FirmwareDeviceIO(BinaryIO):
@@ -87,6 +135,10 @@ class FirmwareDeviceIO(BinaryIO):
     bootloader: int
     size: int
     BLOCKSIZE: int = BLOCKSIZE
+    # Each esptool command has a high overhead, so copy data in large chunks
+    IO_CHUNK: int = 256 * BLOCKSIZE
+    CACHE_BLOCKS: int = 64  # Max number of flash blocks kept in the read cache
+    WRITE_BUFFER: int = 16 * BLOCKSIZE  # Max bytes of small writes held back
     esptool: ESPTool
 
     def __init__(
@@ -94,22 +146,30 @@ class FirmwareDeviceIO(BinaryIO):
         port: str,
         baud: int = 0,
         *,
-        esptool_method: str = "subprocess",
+        esptool_method: str = "direct",
         reset_on_close: bool = True,
         check: bool = True,
     ):
         if not os.path.exists(port):
             raise FileNotFoundError(f"No such device: '{port}'")
+        # Defer importing esptool until a device is opened: saves startup time
+        from .esptool_io import get_esptool
+
         self.esptool = get_esptool(port, baud, method=esptool_method)
         self.size = self.esptool.flash_size
         self._pos: int = 0
         self._end: int = self.size
         self._reset_on_close: bool = reset_on_close
-        self.bootloader = BOOTLOADER_OFFSET[self.esptool.chip_name]
+        # LRU cache of recently read flash blocks, indexed by block offset
+        self._cache: OrderedDict[int, bytes] = OrderedDict()
+        # Small writes are held back and sent to the device together by flush()
+        self._writes: list[tuple[int, bytes]] = []
+        self.bootloader = BOOTLOADER_OFFSET.get(self.esptool.chip_name, 0)
+        # Read the whole first bootloader block: it stays in the block cache
+        # for later reads of the bootloader header (eg. `update_bootloader()`)
+        self.header = ImageHeader.from_bytes(self.pread(self.bootloader, BLOCKSIZE))
         self.seek(self.bootloader)
         # Check the bootloader header matches the detected device
-        self.header = ImageHeader.from_file(self)
-        self.seek(self.bootloader)
         if not check:
             return  # Skip checking the bootloader header
 
@@ -138,24 +198,133 @@ class FirmwareDeviceIO(BinaryIO):
     def __enter__(self) -> FirmwareDeviceIO:
         return self
 
-    def read(self, size: int | None = None) -> bytes:
-        size = size if size is not None else self._end - self._pos
-        log.debug(f"Reading {size:#x} bytes from {self._pos:#x}...")
-        data = self.esptool.read_flash(self._pos, size)
+    def _read_flash(self, pos: int, size: int) -> bytes:
+        """Read `size` bytes from the device flash storage at `pos`."""
+        self.flush()  # Make sure any held back writes are on the device
+        log.debug(f"Reading {size:#x} bytes from {pos:#x}...")
+        data = self.esptool.read_flash(pos, size)
         if len(data) != size:
             raise ValueError(f"Read {len(data)} bytes from device, expected {size}.")
+        return data
+
+    def _read_cached(self, pos: int, size: int) -> bytes:
+        """Read `size` bytes at `pos` using the block cache. Any blocks not in
+        the cache are read from the device in a single operation."""
+        bs, cache = self.BLOCKSIZE, self._cache
+        start, end = pos - pos % bs, (pos + size + bs - 1) // bs * bs
+        missing = [b for b in range(start, end, bs) if b not in cache]
+        if missing:
+            first, last = missing[0], missing[-1] + bs
+            data = self._read_flash(first, last - first)
+            for b in range(first, last, bs):
+                if b not in cache:
+                    cache[b] = data[b - first : b - first + bs]
+        blocks = []
+        for b in range(start, end, bs):
+            cache.move_to_end(b)  # Mark block as most recently used
+            blocks.append(cache[b])
+        while len(cache) > self.CACHE_BLOCKS:
+            cache.popitem(last=False)  # Evict the least recently used block
+        return b"".join(blocks)[pos - start : pos - start + size]
+
+    def _invalidate(self, pos: int, size: int) -> None:
+        """Remove any cached blocks which overlap `size` bytes at `pos`."""
+        bs = self.BLOCKSIZE
+        for b in [b for b in self._cache if b + bs > pos and b < pos + size]:
+            del self._cache[b]
+
+    def _changed(self, pos: int, data: Buffer) -> list[tuple[int, memoryview]]:
+        """Return the `(pos, data)` regions of `data` which would change the
+        flash storage if written at `pos`. If all the blocks are in the cache,
+        only the blocks which differ are returned. Otherwise, the MD5 digest of
+        `data` is compared with one calculated on the device (if supported)."""
+        mv, bs = memoryview(data).cast("B"), self.BLOCKSIZE
+        size, start = len(mv), pos - pos % bs
+        if not all(b in self._cache for b in range(start, pos + size, bs)):
+            # Held back writes which overlap `data` are not on the device yet
+            pending = any(p < pos + size and pos < p + len(d) for p, d in self._writes)
+            md5 = None if pending else self.esptool.flash_md5(pos, size)
+            if md5 is not None and md5 == hashlib.md5(mv).digest():
+                return []
+            return [(pos, mv)]
+        old = self._read_cached(pos, size)
+        regions: list[tuple[int, memoryview]] = []
+        for b in range(start, pos + size, bs):
+            i, j = max(b - pos, 0), min(b + bs - pos, size)
+            if mv[i:j] == old[i:j]:
+                continue  # Skip unchanged blocks
+            if regions and regions[-1][0] + len(regions[-1][1]) == pos + i:
+                regions[-1] = (regions[-1][0], mv[regions[-1][0] - pos : j])
+            else:
+                regions.append((pos + i, mv[i:j]))
+        return regions
+
+    def pread(self, pos: int, size: int) -> bytes:
+        """Read `size` bytes from `pos` without moving the file position."""
+        return (
+            self._read_cached(pos, size)
+            if size <= self.CACHE_BLOCKS * self.BLOCKSIZE // 2
+            else self._read_flash(pos, size)  # Large reads bypass the cache
+        )
+
+    def read(self, size: int | None = None) -> bytes:
+        size = size if size is not None else self._end - self._pos
+        data = self.pread(self._pos, size)
         self._pos += len(data)
         return data
 
     def write(self, data: Buffer) -> int:
-        data = memoryview(data)
-        log.debug(f"Writing {len(data):#x} bytes at position {self._pos:#x}...")
-        size = self.esptool.write_flash(self._pos, data)
+        pos, size = self._pos, len(memoryview(data))
+        log.debug(f"Writing {size:#x} bytes at position {pos:#x}...")
+        if pos & (self.BLOCKSIZE - 1):  # Check before the write is held back
+            raise ValueError(f"Device write not block aligned ({pos=:#x}).")
+        if size >= self.WRITE_BUFFER:  # Streamed chunks are written directly
+            self._invalidate(pos, size)
+            self.flush()
+            size = self.esptool.write_flash(pos, data)
+        else:
+            # Flash writes are much slower than reads: only write changed blocks
+            regions = self._changed(pos, data)
+            if not regions:
+                log.debug(f"Skipping unchanged {size:#x} bytes at {pos:#x}.")
+            for p, d in regions:
+                self._hold_write(p, d)
         self._pos += size
         return size
 
+    def _hold_write(self, pos: int, data: Buffer) -> None:
+        """Hold back a small write to be sent to the device by `flush()`."""
+        size, writes = len(memoryview(data)), self._writes
+        self._invalidate(pos, size)
+        if any(p < pos + size and pos < p + len(d) for p, d in writes):
+            self.flush()  # Don't hold back writes which overlap earlier writes
+        if writes and writes[-1][0] + len(writes[-1][1]) == pos:
+            writes[-1] = (writes[-1][0], writes[-1][1] + bytes(data))  # Contiguous
+        else:
+            writes.append((pos, bytes(data)))
+        if sum(len(d) for _, d in writes) > self.WRITE_BUFFER:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write any held back writes to the device in a single operation."""
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, []
+        size = sum(len(data) for _, data in writes)
+        log.debug(f"Writing {size:#x} bytes to {len(writes)} regions...")
+        if (n := self.esptool.write_flash_regions(writes)) != size:
+            raise ValueError(f"Wrote {n} bytes to device, expected {size}.")
+
+    def writev(self, buffers: Sequence[Buffer]) -> int:
+        """Write a sequence of buffers in a single flash write operation."""
+        buffers = [b for b in buffers if memoryview(b).nbytes]  # Drop empty pads
+        if len(buffers) == 1:
+            return self.write(buffers[0])  # Pass a single buffer through uncopied
+        return self.write(b"".join(buffers))
+
     def seek(self, pos: int, whence: int = 0) -> int:
-        self._pos = (0, self._pos, self._end)[whence] + pos
+        base = 0 if whence == 0 else self._pos if whence == 1 else self._end
+        self._pos = base + pos
         return self._pos
 
     def tell(self) -> int:
@@ -168,6 +337,7 @@ class FirmwareDeviceIO(BinaryIO):
         return True
 
     def close(self) -> None:
+        self.flush()
         if self._reset_on_close:
             log.debug("Resetting out of bootloader mode using RTS pin...")
             self.esptool.hard_reset()
@@ -175,6 +345,7 @@ class FirmwareDeviceIO(BinaryIO):
             log.action("Leaving device in bootloader mode...")
 
         self.esptool.close()  # esptool does not close the port
+        self._cache.clear()
         self._pos = 0
         self._end = 0
 
@@ -182,8 +353,14 @@ class FirmwareDeviceIO(BinaryIO):
     def erase(self, size: int) -> None:
         """Erase a region of the device flash storage using `esptool.py`.
         Size should be a multiple of `0x1000 (4096)`, the device block size"""
-        log.debug(f"Erasing {size:#x} bytes at position {self._pos:#x}...")
-        self.esptool.erase_flash(self._pos, size)
+        pos, bs = self._pos, self.BLOCKSIZE
+        log.debug(f"Erasing {size:#x} bytes at position {pos:#x}...")
+        if all(self._cache.get(b) == ERASED_BLOCK for b in range(pos, pos + size, bs)):
+            log.debug(f"Skipping erased {size:#x} bytes at {pos:#x}.")
+        else:
+            self._invalidate(pos, size)
+            self.flush()  # Held back writes must reach the device before the erase
+            self.esptool.erase_flash(pos, size)
         self._pos += size
 
 
@@ -199,6 +376,7 @@ class Partition(BinaryIO):
         self.file = file
         self.part = part
         self._pos: int = 0
+        self._is_file = isinstance(file, FirmwareFileIO)
         if part.offset >= file.size:
             raise ValueError(f"Partition '{part.name}' is not in firmware file.")
         self.seek(0)
@@ -225,37 +403,37 @@ class Partition(BinaryIO):
     def tell(self) -> int:
         return self._pos
 
+    def _past_end_of_file(self) -> bool:
+        """Return `True` if this is the last partition of a firmware file and
+        extends past the end of the file."""
+        return self._is_file and self.part.offset + self.part.size > self.file.size
+
     def read(self, size: int | None = None) -> bytes:
-        pos = self._pos
-        if size is None or pos + size > self.part.size:
-            size = self.part.size - pos
-        b = self.file.read(size)
+        pos, part = self._pos, self.part
+        if size is None or pos + size > part.size:
+            size = part.size - pos
+        b = self.file.pread(part.offset + pos, size)
         self._pos += len(b)
         return b
 
     def write(self, data: Buffer) -> int:
         data = memoryview(data)
-        pos, size, name = self._pos, len(data), self.part.name
-        if not 0 <= pos + size <= self.part.size:
+        file, part = self.file, self.part
+        pos, size, name = self._pos, len(data), part.name
+        blockmask = file.BLOCKSIZE - 1  # BLOCKSIZE is a power of 2
+        if not 0 <= pos + size <= part.size:
             raise ValueError(
                 f"Partition '{name}': Invalid write ({pos=:#x} {size=:#x})."
             )
-        if pos % self.file.BLOCKSIZE != 0:
+        if pos & blockmask:
             raise ValueError(
                 f"Partition '{name}': Write not block aligned ({pos=:#x})."
             )
-        skip_erase = (
-            # If the last partition of a firmware file, dont erase trailing blocks
-            isinstance(self.file, FirmwareFileIO)
-            and self.part.offset + self.part.size > self.file.size
-        )
-        pad = 0
-        if not skip_erase:
-            remainder = len(data) % self.file.BLOCKSIZE
-            pad = self.file.BLOCKSIZE - remainder if remainder else 0
+        # If the last partition of a firmware file, dont erase trailing blocks
+        pad = 0 if self._past_end_of_file() else -size & blockmask
 
-        self.seek(pos)
-        res = self.file.write(b"" + data + b"\xff" * pad)  # Write data: pad with 0xff
+        file.seek(part.offset + pos)
+        res = file.writev((data, ERASED_BLOCK[:pad]))  # Write data: pad with 0xff
         res -= pad  # Subtract the padding from the write length
         if res != size:
             raise ValueError(f"Partition {name}: Write failed: ({size=:#x} {res=:#x}.")
@@ -264,17 +442,14 @@ class Partition(BinaryIO):
 
     def truncate(self, size: int | None = None) -> int:
         size = size if size is not None else self._pos
-        if (
-            isinstance(self.file, FirmwareFileIO)
-            and self.part.offset + self.part.size > self.file.size
-        ):
+        if self._past_end_of_file():
             # If the last partition of a firmware file, dont erase trailing blocks
             self.seek(size)
             self.file.truncate()  # Truncate the file to the new size
             return size
         else:
-            nextblock = (size + self.file.BLOCKSIZE - 1) // self.file.BLOCKSIZE
-            size = nextblock * self.file.BLOCKSIZE
+            blockmask = self.file.BLOCKSIZE - 1  # BLOCKSIZE is a power of 2
+            size = (size + blockmask) & ~blockmask
             self.seek(size)  # Seek to the next block
             log.action(f"Erasing partition '{self.part.name}' from {size:#x}...")
             self.file.erase(self.part.size - size)
@@ -2,7 +2,6 @@ from __future__ import annotations
 
 import binascii
 import hashlib
-import math
 from ctypes import (
     Array,
     LittleEndianStructure,
@@ -13,7 +12,9 @@ from ctypes import (
     sizeof,
 )
 from functools import cached_property
-from typing import IO, Any, Tuple
+from typing import IO, Any, Iterable, Tuple
+
+from typing_extensions import Buffer
 
 MB = 1024 * 1024
 
@@ -95,6 +96,7 @@ class ImageHeader(ImageHeaderStruct):
     def __init__(self, *args: Any, **kwargs: Any):
         super().__init__(*args, **kwargs)
         self.validate()
+        self.initial_crc32 = binascii.crc32(self)  # Calculate the checksum
 
     def is_erased(self) -> bool:
         return bytes(self).count(0xFF) == sizeof(self)
@@ -104,7 +106,6 @@ class ImageHeader(ImageHeaderStruct):
             raise ValueError("Invalid image file: magic bytes not found.")
         if not self.chip_name.startswith("esp32"):
             raise ValueError("Invalid chip id in image header.")
-        self.initial_crc32 = binascii.crc32(self)  # Calculate the checksum
         return self
 
     def ismodified(self) -> bool:
@@ -125,9 +126,10 @@ class ImageHeader(ImageHeaderStruct):
     @flash_size.setter
     def flash_size(self, flash_size: int) -> None:
         """Set the flash size in the bootloader header."""
-        if not (0 <= flash_size <= 256 * MB):
+        if not (MB <= flash_size <= 256 * MB):  # log2() of the size in MB >= 0
             raise ValueError(f"Invalid flash size: {flash_size:#x}.")
-        self.flash_size_id = round(math.log2(flash_size / MB))
+        # round(log2(size in MB)) in integer arithmetic: floor(log2(2 * size^2)) / 2
+        self.flash_size_id = ((2 * flash_size**2 // MB**2).bit_length() - 1) // 2
 
     @property
     def size(self) -> int:
@@ -139,8 +141,9 @@ class ImageHeader(ImageHeaderStruct):
         return ImageHeader.from_bytes(bytes(self))
 
     @classmethod
-    def from_bytes(cls, data: bytes | bytearray) -> ImageHeader:
-        """Read the image header from a file."""
+    def from_bytes(cls, data: Buffer) -> ImageHeader:
+        """Read the image header from the start of `data`."""
+        data = memoryview(data)[: sizeof(cls)]  # Only need the header bytes
         hdr = cls.from_buffer_copy(data)
         hdr.initial_crc32 = binascii.crc32(data)
         return hdr
@@ -173,7 +176,8 @@ class ImageHeader(ImageHeaderStruct):
     ) -> tuple[int, bytes]:
         """Check the sha256 hash at the end of the bootloader image data."""
         n = self.get_image_size(data)
-        return n, hashlib.sha256(data[:n]).digest()
+        # hashlib releases the GIL while hashing a large buffer: don't copy it
+        return n, hashlib.sha256(memoryview(data)[:n]).digest()
 
     def check_image_hash(self, data: bytes | bytearray) -> Tuple[int, bytes, bytes]:
         """Check the sha256 hash at the end of the bootloader image data."""
@@ -184,6 +188,37 @@ class ImageHeader(ImageHeaderStruct):
             bytes(data[n : n + len(sha)]),
         )  # Return the size, the calculated hash and the stored hash
 
+    def check_image_hash_stream(
+        self, chunks: Iterable[bytes]
+    ) -> tuple[int, bytes, bytes]:
+        """Check the sha256 hash at the end of the image data read from
+        `chunks`. The hash is calculated in a single pass over the data as it
+        is read and reading stops at the end of the stored hash."""
+        sha = hashlib.sha256()
+        data = b""  # Data read from `chunks` which has not yet been hashed
+        pos = 0  # Offset of `data` from the start of the image
+        n, segments, end = self.size, self.num_segments, 0
+        for chunk in chunks:
+            data += chunk
+            # Skip over each segment in the image as the segment headers arrive
+            while segments and n + 8 <= pos + len(data):
+                n += int.from_bytes(data[n - pos + 4 : n - pos + 8], "little") + 8
+                segments -= 1
+            if not segments and not end:
+                end = (n + 1 + 0xF) & ~0xF  # Allow for checksum and round up
+            # Hash the data up to the next segment header or the end of the image
+            size = min((end or n) - pos, len(data))
+            sha.update(data[:size])
+            data, pos = data[size:], pos + size
+            if end and len(data) >= sha.digest_size:
+                break  # We have the whole image and the stored hash
+        if not end or pos != end:
+            raise ValueError(
+                f"Invalid image file: image size ({end or n} bytes) "
+                f"exceeds data size ({pos + len(data)} bytes)."
+            )
+        return end, sha.digest(), data[: sha.digest_size]
+
     def update_image(self, data: bytes | bytearray) -> Tuple[bytearray, int]:
         """Update the bootloader hash, if it has changed."""
         if not isinstance(data, bytearray):
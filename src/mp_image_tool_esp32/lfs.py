@@ -101,6 +101,20 @@ class BlockCache(DefaultDict[int, bytes]):
         super().__setitem__(block, data)  # Save in the read cache
         return data
 
+    def prefetch(self, blocks: Iterable[int]) -> None:
+        """Read any `blocks` which are not already cached into the read cache.
+        Contiguous blocks are read from the file in a single read operation."""
+        bs = self.block_size
+        missing = sorted({b for b in blocks if b not in self})
+        for group in more_itertools.consecutive_groups(missing):
+            run = list(group)
+            log.debug(f"Prefetch {len(run)} blocks at {run[0]} from file")
+            self.file.seek(run[0] * bs)
+            data = self.file.read(len(run) * bs)
+            for i, block in enumerate(run):
+                if len(block_data := data[i * bs : (i + 1) * bs]) == bs:
+                    super().__setitem__(block, block_data)
+
     def __setitem__(self, block: int, data: bytes) -> None:
         """Save the block data to the cache and write cache."""
         assert len(data) == self.block_size, "Data must be a block size"
@@ -166,6 +180,7 @@ class UserContextFile(UserContext):
 
     def __init__(self, file: BinaryIO, block_size: int = BLOCK_SIZE) -> None:
         self.block_cache = BlockCache(file, block_size)
+        self.erased_block = b"\xff" * block_size  # Shared by all erased blocks
 
     def read_block(self, block: int) -> bytes:
         return self.block_cache[block]
@@ -199,7 +214,7 @@ class UserContextFile(UserContext):
 
     def erase_block(self, block: int) -> int:
         log.debug("LFS Erase: Block: %d" % block)
-        self.write_block(block, b"\xff" * self.block_cache.block_size)
+        self.write_block(block, self.erased_block)
         return 0
 
     def erase(self, cfg: "LFSConfig", block: int) -> int:
@@ -228,8 +243,8 @@ def _is_dir(fs: LittleFS, path: Path) -> bool:
 def _get_file(fs: LittleFS, src: Path, dst: Path) -> None:
     """Copy a file from the LittleFS filesystem to the local filesystem."""
     with fs.open(src.as_posix(), "rb") as f:
-        dst.write_bytes(f.read())
-    assert fs.stat(src.as_posix()).size == dst.stat().st_size
+        size = dst.write_bytes(f.read())
+    assert fs.stat(src.as_posix()).size == size
 
 
 def _put_file(fs: LittleFS, src: Path, dst: Path) -> None:
@@ -240,15 +255,21 @@ def _put_file(fs: LittleFS, src: Path, dst: Path) -> None:
         fs.remove(dst.as_posix())
     except FileNotFoundError:
         pass
+    data = src.read_bytes()  # Check the size of the data read, not a new stat()
     with fs.open(dst.as_posix(), "wb") as f:
-        f.write(src.read_bytes())
-    assert fs.stat(dst.as_posix()).size == src.stat().st_size
+        f.write(data)
+    assert fs.stat(dst.as_posix()).size == len(data)
 
 
-def littlefs(part: BinaryIO, block_count: int = 0) -> LittleFS:
-    """Create a LittleFS filesystem object for a partition."""
+def littlefs(
+    part: BinaryIO, block_count: int = 0, prefetch: Iterable[int] = ()
+) -> LittleFS:
+    """Create a LittleFS filesystem object for a partition. Any `prefetch`
+    blocks are read into the block cache before the filesystem is used."""
+    context = UserContextFile(part, BLOCK_SIZE)
+    context.block_cache.prefetch(prefetch)
     return LittleFS(
-        context=UserContextFile(part, BLOCK_SIZE),
+        context=context,
         block_size=BLOCK_SIZE,
         block_count=block_count,
         mount=False,
@@ -258,7 +279,7 @@ def littlefs(part: BinaryIO, block_count: int = 0) -> LittleFS:
 @contextmanager
 def lfs_mounted(part: BinaryIO) -> Iterator[LittleFS]:
     """A context manager to mount and unmount a LittleFS filesystem."""
-    fs = littlefs(part)
+    fs = littlefs(part, prefetch=range(2))  # Mounting reads both superblocks
     fs.mount()
     try:
         yield fs
@@ -2,12 +2,11 @@
 """A wrapper module to provide a consistent interface for logging to console."""
 
 import logging
+import os
 import typing
+from importlib.util import find_spec
 from typing import Any
 
-import esptool
-import littlefs
-import serial
 from rich.console import Console, ConsoleRenderable
 from rich.highlighter import NullHighlighter
 from rich.logging import RichHandler
@@ -43,6 +42,12 @@ class Handler(RichHandler):
         )
 
 
+def package_dir(name: str) -> str:
+    """Return the directory of the package `name` without importing it."""
+    spec = find_spec(name)
+    return os.path.dirname(spec.origin) if spec and spec.origin else name
+
+
 # Create a RichHandler with a custom themed console
 richhandler = Handler(
     console=console,
@@ -52,7 +57,8 @@ richhandler = Handler(
     show_level=False,
     show_path=False,
     rich_tracebacks=True,
-    tracebacks_suppress=[esptool, serial, littlefs],
+    # Use paths: importing esptool here would slow startup for firmware files
+    tracebacks_suppress=[package_dir(m) for m in ("esptool", "serial", "littlefs")],
 )
 richhandler.setFormatter(logging.Formatter(FORMAT))
 
@@ -19,7 +19,6 @@ import platform
 import re
 import shutil
 import sys
-from pathlib import Path
 from typing import List, Sequence
 
 from . import __version__, layouts, logger, ota_update
@@ -197,213 +196,209 @@ def run_commands(argv: Sequence[str] | None = None) -> None:
         reset_on_close=not args.no_reset,
         esptool_method=args.method,
     )
-    input_type: str = "device" if firmware.is_device else "firmware file"
-    log.info(
-        f"Found {firmware.header.chip_name} {input_type} "
-        f"({firmware.header.flash_size // MB}MB flash)."
-    )
-    app_size = 0
-    if not firmware.is_device:
-        app_size = firmware.file.seek(0, 2) - firmware.table.app_part.offset
-        firmware.file.seek(firmware.bootloader)
-    if log.isEnabledFor(logging.INFO):
-        layouts.print_partition_table(firmware.table, app_size)
-        if firmware.is_device and not args.fs:
-            lfs_cmd(firmware, "df")  # Display filesystem usage information
-
-    ## Process requested changes to the firmware file (esp. partition table)
-
-    # Make a copy of the partition table and image header for modification
-    new_table: PartitionTable = copy.copy(firmware.table)
-    new_header = firmware.file.header.copy()
-    extension = ""  # Each op that changes table adds identifier to extension
-
-    if args.extract_app:  # -x --extract-app : Extract app image from firmware
-        output = args.output or re.sub(r"(.bin)?$", ".app-bin", basename, 1)
-        log.action(f"Writing micropython app image file: {output}...")
-        firmware.save_app_image(output)
-        firmware.file.close()
-        return
-
-    if args.flash_size:  # -f --flash-size SIZE : Set size of the flash storage
-        max_flash_size = getattr(firmware.file, "flash_size", 1024 * MB)
-        if args.flash_size > max_flash_size:
-            raise ValueError(
-                "Selected flash size is larger than device flash size "
-                f"({args.flash_size // MB}MB > {max_flash_size // MB}MB).",
-            )
-        if args.flash_size != new_header.flash_size:
-            new_table.max_size = args.flash_size
-            new_header.flash_size = args.flash_size
-            assert new_header.ismodified(), "Image header not modified!"
-        extension += f"-{args.flash_size // MB}MB"
-
-    if args.from_csv:  # --from-csv FILE : Replace part table from CSV file.
-        new_table = layouts.from_csv(new_table, args.from_csv)
-        extension += "-CSV"
-
-    if args.table:  # --table default|ota|nvs=7B,factory=2M,vfs=0
-        if str(args.table) == "ota":
-            # ota_layout returns a string, so parse it into a PartList
-            args.table = PartList(layouts.ota_layout(new_table, args.app_size))
-            extension += "-OTA"
-        elif str(args.table) == "default":
-            # DEFAULT_TABLE_LAYOUT is a string, so parse it into a PartList
-            args.table = PartList(layouts.DEFAULT_TABLE_LAYOUT)
-            extension += "-DEFAULT"
-        elif str(args.table) == "original":
-            # DEFAULT_TABLE_LAYOUT is a string, so parse it into a PartList
-            args.table = PartList(layouts.ORIGINAL_TABLE_LAYOUT)
-            extension += "-ORIGINAL"
-        else:
-            extension += "-TABLE"
-        # Build a partition table from the PartList
-        new_table = layouts.new_table(new_table, args.table, app_size)
-        new_table.check()
-
-    if args.app_size:  # -a --app-size SIZE : Resize all the APP partitions
-        app_parts = filter(lambda p: p.type == new_table.APP_TYPE, new_table)
-        for e in app_parts:
-            new_table.resize_part(e.name, args.app_size)
-        extension += f"-appsize={args.app_size // B}B"
-
-    if args.delete:  # --delete name1[,name2,..] : Delete partition from table
-        for name, *_ in args.delete:
-            new_table.remove(new_table.by_name(name))
-        extension += f"-delete={args.delete}"
-
-    if args.resize:  # --resize NAME1=SIZE[,NAME2=...] : Resize partitions
-        for name, *_, new_size in args.resize:
-            log.action(f"Resizing {name} partition to {new_size:#x} bytes...")
-            new_table.resize_part(name, new_size)
-        new_table.check()
-        extension += f"-resize={args.resize}"
-
-    if args.add:  # --add NAME1=SUBTYPE:OFFSET:SIZE[,..] : Add new partitions
-        for name, subtype, offset, size in args.add:
-            subtype = layouts.get_subtype(name, subtype)
-            new_table.add_part(name, subtype, size, offset)
-        extension += f"-add={args.add}"
-
-    ## We have performed all the changes to the partition table...
-    ## Write modified partition table to a new file or back to flash storage
-
-    if args.erase and not firmware.is_device:
-        extension += f"-erase={args.erase}"
-    if args.write and not firmware.is_device:
-        extension += f"-write={args.write}"
-
-    if extension or args.output:  # A change has been made to the partition table
-        if new_table.app_part.offset != firmware.table.app_part.offset:
-            raise PartitionError("first app partition offset has changed", new_table)
-        if log.isEnabledFor(logging.INFO):
-            layouts.print_partition_table(new_table, app_size)
-        if not firmware.is_device:  # If input is a firmware file, make a copy
-            # Make a copy of the firmware file and open the new firmware...
-            output_filename = args.output or re.sub(
-                r"([.][^.]+)?$", f"{extension}\\1", basename, 1
-            )
-            firmware.file.close()
-            shutil.copy(input, output_filename)
-            firmware = Firmware(output_filename)
-
-        # Update the firmware with the new partition table and bootloader header...
-        log.action(
-            f"Writing to {firmware.header.chip_name} {input_type}: {firmware.filename}..."
+    try:
+        input_type: str = "device" if firmware.is_device else "firmware file"
+        log.info(
+            f"Found {firmware.header.chip_name} {input_type} "
+            f"({firmware.header.flash_size // MB}MB flash)."
         )
-        firmware.update_image(new_table, new_header)
-
-    ## For erasing/reading/writing flash storage partitions
-
-    if args.erase:  # --erase NAME1[,NAME2,...] : Erase partition
-        for name, *_ in args.erase:
-            log.action(f"Erasing partition '{name}'...")
-            with firmware.partition(name) as p:
-                p.truncate()
-
-    if args.erase_fs:  # --erase-fs NAME1[,...] : Erase first 4 blocks of parts
+        app_size = 0
         if not firmware.is_device:
-            raise ValueError("--erase-fs requires an esp32 device")
-        # Micropython will automatically re-initialise the filesystem on boot.
-        for name, *_ in args.erase_fs:
-            part = firmware.table.by_name(name)
-            if part.subtype_name not in ("fat",):
-                raise PartitionError(f"partition '{part.name}' is not a fs partition.")
-            log.action(f"Erasing filesystem on partition '{part.name}'...")
-            with firmware.partition(part) as p:
-                p.erase(4 * 0x1000)
-
-    if args.read:  # --read NAME1=FILE1[,...]: Read contents of parts into FILES
-        for name, filename in args.read:
-            log.action(f"Saving partition '{name}' into '{filename}'...")
-            data = firmware.partition(name).read()
-            if args.trimblocks:  # Trim trailing blank 4096-byte blocks from data
-                data = firmware.trimblocks(data)
-            if args.trim:  # Trim trailing blank 16-byte blocks from data
-                data = firmware.trimblocks(data, 16)
-            n = Path(filename).write_bytes(data)
-            log.info(f"Wrote {n:,} bytes to '{filename}'.")
-
-    if args.write:  # --write NAME1=FILE1[,...] : Write FILES into partitions
-        for name, filename in args.write:
-            log.action(f"Writing partition '{name}' from '{filename}'...")
-            data = Path(filename).read_bytes()
-            with firmware.partition(name) as p:
-                if p.part.type_name == "app" and not firmware.check_app_image_header(
-                    data, p.part.name
-                ):
-                    raise ValueError(
-                        f"Attempt to write invalid app image to '{p.part.name}'."
-                    )
-                n = p.write(data)
-                p.truncate()
-            log.info(f"Wrote {n:#x} bytes to partition '{name}'.")
-
-    if args.ota_update:  # --ota-update FILE : Perform an OTA firmware upgrade
-        if not firmware.is_device:
-            raise ValueError("--ota-update requires an esp32 device")
-        log.action(f"Performing OTA firmware upgrade from '{args.ota_update}'...")
-        ota_update.ota_update(firmware, args.ota_update, args.no_rollback)
-
-    if args.check_app:  # --check-app : Check the partition table and app images
-        firmware.check_app_partitions(firmware.table, check_hash=True)
-        try:
-            ota = ota_update.OTAUpdater(firmware)
-            log.info(f"Current OTA boot partition: {ota.current().name}")
-            log.info(f"Next OTA boot partition: {ota.get_next_update().name}")
-        except PartitionError:
-            pass  # No OTA partitions
-
-    if args.fs:  # --fs CMD NAME1[,NAME2,...] : Perform a filesystem command
-        # Process any littlefs filesystem commands
-        for command, *fs_args in args.fs:
-            lfs_cmd(firmware, command, fs_args)
-
-    if args.flash:  # --flash DEVICE : Flash firmware to the device
-        filename = expand_device_short_names(args.flash)
-        device = None
-        log.action(f"Opening device '{filename}' for flashing...")
-        try:
-            device = Firmware(
-                filename,
-                args.baud,
-                reset_on_close=not args.no_reset,
-                esptool_method=args.method,
-                check=False,  # Bootloader on device may be missing or broken
-            )
-            if not device.is_device:
-                raise ValueError("Flashing requires a device, not a firmware file.")
-            log.info(
-                f"Found {device.header.chip_name} device "
-                f"({device.header.flash_size // MB}MB flash)."
+            app_size = firmware.size - firmware.table.app_part.offset
+        if log.isEnabledFor(logging.INFO):
+            layouts.print_partition_table(firmware.table, app_size)
+            if firmware.is_device and not args.fs:
+                lfs_cmd(firmware, "df")  # Display filesystem usage information
+
+        ## Process requested changes to the firmware file (esp. partition table)
+
+        # Make a copy of the partition table and image header for modification
+        new_table: PartitionTable = copy.copy(firmware.table)
+        new_header = firmware.file.header.copy()
+        extension = ""  # Each op that changes table adds identifier to extension
+
+        if args.extract_app:  # -x --extract-app : Extract app image from firmware
+            output = args.output or re.sub(r"(.bin)?$", ".app-bin", basename, 1)
+            log.action(f"Writing micropython app image file: {output}...")
+            firmware.save_app_image(output)
+            return
+
+        if args.flash_size:  # -f --flash-size SIZE : Set size of the flash storage
+            max_flash_size = getattr(firmware.file, "flash_size", 1024 * MB)
+            if args.flash_size > max_flash_size:
+                raise ValueError(
+                    "Selected flash size is larger than device flash size "
+                    f"({args.flash_size // MB}MB > {max_flash_size // MB}MB).",
+                )
+            if args.flash_size != new_header.flash_size:
+                new_table.max_size = args.flash_size
+                new_header.flash_size = args.flash_size
+                assert new_header.ismodified(), "Image header not modified!"
+            extension += f"-{args.flash_size // MB}MB"
+
+        if args.from_csv:  # --from-csv FILE : Replace part table from CSV file.
+            new_table = layouts.from_csv(new_table, args.from_csv)
+            extension += "-CSV"
+
+        if args.table:  # --table default|ota|nvs=7B,factory=2M,vfs=0
+            if str(args.table) == "ota":
+                # ota_layout returns a string, so parse it into a PartList
+                args.table = PartList(layouts.ota_layout(new_table, args.app_size))
+                extension += "-OTA"
+            elif str(args.table) == "default":
+                # DEFAULT_TABLE_LAYOUT is a string, so parse it into a PartList
+                args.table = PartList(layouts.DEFAULT_TABLE_LAYOUT)
+                extension += "-DEFAULT"
+            elif str(args.table) == "original":
+                # DEFAULT_TABLE_LAYOUT is a string, so parse it into a PartList
+                args.table = PartList(layouts.ORIGINAL_TABLE_LAYOUT)
+                extension += "-ORIGINAL"
+            else:
+                extension += "-TABLE"
+            # Build a partition table from the PartList
+            new_table = layouts.new_table(new_table, args.table, app_size)
+            new_table.check()
+
+        if args.app_size:  # -a --app-size SIZE : Resize all the APP partitions
+            app_parts = filter(lambda p: p.type == new_table.APP_TYPE, new_table)
+            for e in app_parts:
+                new_table.resize_part(e.name, args.app_size)
+            extension += f"-appsize={args.app_size // B}B"
+
+        if args.delete:  # --delete name1[,name2,..] : Delete partition from table
+            for name, *_ in args.delete:
+                new_table.remove(new_table.by_name(name))
+            extension += f"-delete={args.delete}"
+
+        if args.resize:  # --resize NAME1=SIZE[,NAME2=...] : Resize partitions
+            for name, *_, new_size in args.resize:
+                log.action(f"Resizing {name} partition to {new_size:#x} bytes...")
+                new_table.resize_part(name, new_size)
+            new_table.check()
+            extension += f"-resize={args.resize}"
+
+        if args.add:  # --add NAME1=SUBTYPE:OFFSET:SIZE[,..] : Add new partitions
+            for name, subtype, offset, size in args.add:
+                subtype = layouts.get_subtype(name, subtype)
+                new_table.add_part(name, subtype, size, offset)
+            extension += f"-add={args.add}"
+
+        ## We have performed all the changes to the partition table...
+        ## Write modified partition table to a new file or back to flash storage
+
+        if args.erase and not firmware.is_device:
+            extension += f"-erase={args.erase}"
+        if args.write and not firmware.is_device:
+            extension += f"-write={args.write}"
+
+        if extension or args.output:  # A change has been made to the partition table
+            if new_table.app_part.offset != firmware.table.app_part.offset:
+                raise PartitionError(
+                    "first app partition offset has changed", new_table
+                )
+            if log.isEnabledFor(logging.INFO):
+                layouts.print_partition_table(new_table, app_size)
+            if not firmware.is_device:  # If input is a firmware file, make a copy
+                # Make a copy of the firmware file and open the new firmware...
+                output_filename = args.output or re.sub(
+                    r"([.][^.]+)?$", f"{extension}\\1", basename, 1
+                )
+                firmware.file.close()
+                shutil.copy(input, output_filename)
+                firmware = Firmware(output_filename)
+
+            # Update the firmware with the new partition table and bootloader header...
+            log.action(
+                f"Writing to {firmware.header.chip_name} {input_type}: {firmware.filename}..."
             )
-            log.action(f"Flashing firmware to device: {filename}...")
-            device.write_firmware(firmware)
-        finally:
-            if device:
-                device.file.close()
-
-    firmware.file.close()
+            firmware.update_image(new_table, new_header)
+
+        ## For erasing/reading/writing flash storage partitions
+
+        if args.erase:  # --erase NAME1[,NAME2,...] : Erase partition
+            for name, *_ in args.erase:
+                log.action(f"Erasing partition '{name}'...")
+                with firmware.partition(name) as p:
+                    p.truncate()
+
+        if args.erase_fs:  # --erase-fs NAME1[,...] : Erase first 4 blocks of parts
+            if not firmware.is_device:
+                raise ValueError("--erase-fs requires an esp32 device")
+            # Micropython will automatically re-initialise the filesystem on boot.
+            regions = []
+            for name, *_ in args.erase_fs:
+                part = firmware.table.by_name(name)
+                if part.subtype_name not in ("fat",):
+                    raise PartitionError(
+                        f"partition '{part.name}' is not a fs partition."
+                    )
+                log.action(f"Erasing filesystem on partition '{part.name}'...")
+                regions.append((part.offset, min(part.size, 4 * B)))
+            firmware.erase_regions(regions)
+
+        if args.read:  # --read NAME1=FILE1[,...]: Read contents of parts into FILES
+            for name, filename in args.read:
+                log.action(f"Saving partition '{name}' into '{filename}'...")
+                blocksize = 0
+                if args.trimblocks:  # Trim trailing blank 4096-byte blocks from data
+                    blocksize = firmware.BLOCKSIZE
+                if args.trim:  # Trim trailing blank 16-byte blocks from data
+                    blocksize = 16
+                n = firmware.save_part_image(name, filename, blocksize)
+                log.info(f"Wrote {n:,} bytes to '{filename}'.")
+
+        if args.write:  # --write NAME1=FILE1[,...] : Write FILES into partitions
+            for name, filename in args.write:
+                log.action(f"Writing partition '{name}' from '{filename}'...")
+                n = firmware.load_part_image(name, filename)
+                log.info(f"Wrote {n:#x} bytes to partition '{name}'.")
+
+        if args.ota_update:  # --ota-update FILE : Perform an OTA firmware upgrade
+            if not firmware.is_device:
+                raise ValueError("--ota-update requires an esp32 device")
+            log.action(f"Performing OTA firmware upgrade from '{args.ota_update}'...")
+            ota_update.ota_update(firmware, args.ota_update, args.no_rollback)
+
+        if args.check_app:  # --check-app : Check the partition table and app images
+            firmware.check_app_partitions(firmware.table, check_hash=True)
+            try:
+                ota = ota_update.OTAUpdater(firmware)
+                log.info(f"Current OTA boot partition: {ota.current().name}")
+                log.info(f"Next OTA boot partition: {ota.get_next_update().name}")
+            except PartitionError:
+                pass  # No OTA partitions
+
+        if args.fs:  # --fs CMD NAME1[,NAME2,...] : Perform a filesystem command
+            # Process any littlefs filesystem commands
+            for command, *fs_args in args.fs:
+                lfs_cmd(firmware, command, fs_args)
+
+        if args.flash:  # --flash DEVICE : Flash firmware to the device
+            filename = expand_device_short_names(args.flash)
+            device = None
+            log.action(f"Opening device '{filename}' for flashing...")
+            try:
+                device = Firmware(
+                    filename,
+                    args.baud,
+                    reset_on_close=not args.no_reset,
+                    esptool_method=args.method,
+                    check=False,  # Bootloader on device may be missing or broken
+                )
+                if not device.is_device:
+                    raise ValueError("Flashing requires a device, not a firmware file.")
+                log.info(
+                    f"Found {device.header.chip_name} device "
+                    f"({device.header.flash_size // MB}MB flash)."
+                )
+                log.action(f"Flashing firmware to device: {filename}...")
+                device.write_firmware(firmware)
+            finally:
+                if device:
+                    device.file.close()
+    finally:
+        # Close on errors too: flushes any writes held back by the device
+        firmware.file.close()
 
 
 def main(argv: Sequence[str] | None = None) -> int:
@@ -19,11 +19,11 @@ import struct
 import typing
 from enum import IntEnum
 from functools import cached_property
-from pathlib import Path
 from typing import List
 
 from . import logger
 from .firmware import Firmware
+from .firmware_fileio import ERASED_BLOCK
 from .partition_table import PartitionEntry
 
 log = logger.getLogger(__name__)
@@ -133,11 +133,14 @@ class OTAUpdater:
         if seq == start:
             log.warning(f"'{part.name}' is already set for booting.")
             return
-        data = (
-            ota_record(seq, OtaState.UNDEFINED if self.no_rollback else OtaState.NEW)
-            + b"\xff" * (0x1000 - OTA_SIZE)
-            + ota_record(self.ota_sequence_number, OtaState.VALID)
-            + b"\xff" * (0x1000 - OTA_SIZE)
+        state = OtaState.UNDEFINED if self.no_rollback else OtaState.NEW
+        data = b"".join(
+            (
+                ota_record(seq, state),
+                ERASED_BLOCK[OTA_SIZE:],
+                ota_record(self.ota_sequence_number, OtaState.VALID),
+                ERASED_BLOCK[OTA_SIZE:],
+            )
         )
         with self.image.partition(self.otadata_part) as p:
             if p.write(data) != len(data):
@@ -164,9 +167,7 @@ def ota_update(image: Firmware, firmware: str, no_rollback: bool = False) -> Non
 
     new_part = ota.get_next_update()  # Get the next available OTA update partition
     log.action(f"Writing firmware to OTA partition {new_part.name}...")
-    with image.partition(new_part) as p:
-        p.write(Path(firmware).read_bytes())
-        p.truncate()
+    image.load_part_image(new_part, firmware, check_app=False)
 
     log.action("Updating otadata partition...")
     ota.set_boot(new_part)
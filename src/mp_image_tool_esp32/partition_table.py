@@ -219,14 +219,8 @@ class PartitionTable(List[PartitionEntry]):
         """Save the partition table in firmware format."""
         data = b"".join((p.to_bytes() for p in self))
         md5 = hashlib.md5(data).digest()
-        data = b"".join(
-            (
-                data,
-                PART_CHKSUM_MAGIC.ljust(16, b"\xff"),
-                md5,
-                (b"\xff" * (self.PART_TABLE_SIZE - len(data) - PART_LEN)),
-            )
-        )
+        data = b"".join((data, PART_CHKSUM_MAGIC.ljust(16, b"\xff"), md5))
+        data = data.ljust(self.PART_TABLE_SIZE, b"\xff")  # Pad with 0xff
         assert len(data) == self.PART_TABLE_SIZE
         return data
 
@@ -5,11 +5,11 @@ from __future__ import annotations
 import io
 import re
 import sys
-import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from threading import Lock
-from typing import IO, Any, Callable, Generator
+from threading import Condition, Lock
+from typing import Any, Callable, Generator
 
 import rich.progress
 
@@ -22,39 +22,71 @@ log = logger.getLogger(__name__)
 class StringIO_RW(io.StringIO):
     """A thread-safe StringIO buffer which supports read() and write().
     Writes are to the end of the buffer and reads are from the current position.
-    All data written to the buffer is available in the `output` attribute.
+    Data is discarded from the buffer once it has been read. If `keep_output`
+    is `True`, all data written to the buffer is also saved in the `output`
+    attribute.
     """
 
-    def __init__(self, s: str = ""):
+    def __init__(self, s: str = "", keep_output: bool = False):
         super().__init__()
-        self.output = s
-        self.read_pos = 0
-        self.lock = Lock()
+        # Join the saved output on demand: repeated `str +=` is quadratic
+        self.saved: list[str] = [s] if keep_output and s else []
+        self.keep_output = keep_output
+        self.chunks: deque[str] = deque((s,) if s else ())
+        self.unread = len(s)  # Number of characters written but not yet read
+        self.lock = Condition(Lock())  # Readers wait for writes or close()
 
     def read(self, size: int | None = None) -> str:
-        end = self.read_pos + (size or 1)
-        while not self.closed and len(self.output) < end:
-            time.sleep(0.1)
+        size = size or 1
         with self.lock:
-            s = self.output[self.read_pos : end]
-            self.read_pos = end
+            while not self.closed and self.unread < size:
+                self.lock.wait()  # Woken by write() or close()
+            s = ""
+            while self.chunks and len(s) < size:
+                s += self.chunks.popleft()
+            if len(s) > size:  # Put back the unread remainder of the last chunk
+                self.chunks.appendleft(s[size:])
+                s = s[:size]
+            self.unread -= len(s)
             return s
 
+    def read1(self, size: int = -1) -> str:
+        """Wait for data to be written and return up to `size` characters (or
+        all the unread data if `size` < 0). Returns "" at end of file."""
+        with self.lock:
+            while not self.closed and not self.unread:
+                self.lock.wait()  # Woken by write() or close()
+        return self.read(min(size, self.unread) if size >= 0 else self.unread)
+
+    @property
+    def output(self) -> str:
+        with self.lock:
+            return "".join(self.saved)
+
     def write(self, s: str) -> int:
         if self.closed:
             raise ValueError("I/O operation on closed file.")
         with self.lock:
-            self.output += s
+            if self.keep_output:
+                self.saved.append(s)
+            self.chunks.append(s)
+            self.unread += len(s)
+            self.lock.notify()
             return len(s)
 
+    def close(self) -> None:
+        with self.lock:
+            super().close()
+            self.lock.notify_all()  # Wake any readers waiting for more data
+
 
 # A context manager to redirect stdout and stderr to a buffer
 # Will print stderr to stdout if an error occurs
 # This is used to wrap calls to esptool module functions directly
 class CaptureOutput:
-    def __init__(self, name: str = "esptool"):
+    def __init__(self, name: str = "esptool", keep_output: bool = False):
         self.name = name
-        pipe = StringIO_RW()
+        pipe = StringIO_RW(keep_output=keep_output)
         self.reader = pipe
         self.writer = pipe
         # r, w = os.pipe()
@@ -128,46 +160,57 @@ class ProgressBar:
 PROGRESS_BAR_MESSAGE_REGEXP = re.compile(
     r"(Writing at |Wrote )?([0-9][0-9a-fx]+)[^0-9a-f]"
 )
+# Progress messages are terminated by "\r" or "\x08" instead of "\n"
+LINE_END_REGEXP = re.compile(r"[\n\r\x08]")
 
 
 def monitor_esptool_progress_messages(
-    esptool_stdout: IO[str], update: Callable[[int, int], None]
+    esptool_stdout: StringIO_RW, update: Callable[[int, int], None]
 ) -> None:
     """Monitor the output stream of `esptool.py` for progress messages and
     update the progress bar accordingly. Returns the output as a string."""
-    offset, line = 0, ""
+    offset, partial = 0, ""
     # Can't use readline() as progress messages dont end in "\n"
-    while s := esptool_stdout.read(1):
-        if s not in ("\n", "\r", "\x08"):
-            line += s
-        elif line:
+    while s := esptool_stdout.read1(4096):
+        *lines, partial = LINE_END_REGEXP.split(partial + s)
+        for line in filter(None, lines):
             log.debug(line)
-            if match := re.match(PROGRESS_BAR_MESSAGE_REGEXP, line):
+            if match := PROGRESS_BAR_MESSAGE_REGEXP.match(line):
                 current = int(match[2], 0)
                 # On writes, the first number is a starting value - need to subtract
                 offset = offset or (current if match[1] else 0)
                 update(current - offset, 0)  # Update the progress bar
-            line = ""
 
 
 @contextmanager
 def EsptoolMonitor(
-    size: int = 0, *, name: str = ""
+    size: int = 0, *, name: str = "", keep_output: bool = False
 ) -> Generator[CaptureOutput, None, None]:
     """Show a progress bar for `esptool.py` reads and writes.
     A context manager that captures sys.stdout while executing the body of the
     `with` block and shows a progress bar for `esptool.py` transfers above 64
-    KB. The captured `stdout` output is saved in the `output` attribute.
+    KB. The captured `stdout` output is saved in the `output` attribute if
+    `keep_output` is `True`.
 
     - `size` is the expected size of the read/write operation.
     - `name` is the name shown in the progress bar and in error messages.
+    - `keep_output` saves the captured output (which may be large for
+      transfers).
 
     The progress bar is run in a separate thread while executing the body of the
-    `with` block.
+    `with` block. No progress bar or thread is used for operations smaller than
+    `ProgressBar.MIN_SIZE`: captured output is processed after the body exits.
     """
+    if size < ProgressBar.MIN_SIZE:
+        with CaptureOutput(name, keep_output) as capture:  # Redirect stdout to a buffer
+            yield capture
+            capture.writer.close()
+            # Process the captured output for debug logging
+            monitor_esptool_progress_messages(capture.reader, lambda *_: None)
+        return
     # Do progress bar first so it outputs to sys.stdout before it is redirected
     with ProgressBar(total=size, name=name) as pbar:
-        with CaptureOutput(name) as capture:  # Redirect stdout to a buffer
+        with CaptureOutput(name, keep_output) as capture:  # Redirect stdout to a buffer
             with ThreadPoolExecutor() as executor:
                 # Run the monitor in a separate thread
                 monitor = executor.submit(
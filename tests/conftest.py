@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 import importlib
 import logging
 import os
@@ -10,14 +11,15 @@ import subprocess
 import warnings
 from argparse import Namespace
 from pathlib import Path
-from typing import Any
+from typing import Any, Sequence
 
 import pytest
 import requests
 from _pytest.config import Config
+from typing_extensions import Buffer
 
 import mp_image_tool_esp32
-from mp_image_tool_esp32 import data_table
+from mp_image_tool_esp32 import data_table, esptool_io
 
 rootdir: Path = Path(__file__).parent.parent  # The root directory of the project
 testsdir: Path = Path(__file__).parent  # Location for test files
@@ -252,6 +254,71 @@ def mock_device(mock_device_session: Path) -> Path:
     return device
 
 
+class FakeESPTool(esptool_io.ESPTool):
+    """An `ESPTool` which reads and writes the flash storage of a fake device
+    held in a `bytearray`. Each flash operation is recorded in `calls`."""
+
+    def __init__(self, port: str, baud: int = 0, *, md5: bool = True) -> None:
+        self.port, self.baud = port, baud
+        self.chip_name, self.flash_size = "esp32", 4 * MB
+        self.flash = bytearray(b"\xff" * self.flash_size)
+        self.md5 = md5  # Can the fake device calculate MD5 digests?
+        self.calls: list[tuple[Any, ...]] = []
+
+    def esptool_cmd(self, command: str | Sequence[str], *, size: int = 0) -> str:
+        return ""
+
+    def write_flash(self, pos: int, data: Buffer) -> int:
+        return self.write_flash_regions(((pos, data),))
+
+    def write_flash_regions(self, regions: Sequence[tuple[int, Buffer]]) -> int:
+        size = 0
+        for pos, data in regions:
+            esptool_io.check_alignment("write_flash", pos)
+            mv = memoryview(data).cast("B")
+            self.flash[pos : pos + len(mv)] = mv
+            size += len(mv)
+        self.calls.append(("write", [(p, len(memoryview(d))) for p, d in regions]))
+        return size
+
+    def read_flash(self, pos: int, size: int) -> bytes:
+        self.calls.append(("read", pos, size))
+        return bytes(self.flash[pos : pos + size])
+
+    def erase_flash(self, pos: int, size: int) -> None:
+        esptool_io.check_alignment("erase_flash", pos, size)
+        self.calls.append(("erase", pos, size))
+        self.flash[pos : pos + size] = b"\xff" * size
+
+    def flash_md5(self, pos: int, size: int) -> bytes | None:
+        if not self.md5:
+            return None
+        self.calls.append(("md5", pos, size))
+        return hashlib.md5(self.flash[pos : pos + size]).digest()
+
+    def hard_reset(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def ops(self, *names: str) -> list[tuple[Any, ...]]:
+        """Return the recorded calls for the operations in `names`."""
+        return [call for call in self.calls if call[0] in names]
+
+
+@pytest.fixture()
+def fake_device(firmwarefile: Path, monkeypatch: pytest.MonkeyPatch) -> FakeESPTool:
+    """A fixture to replace the esptool interface with a `FakeESPTool` for the
+    next device opened. Open `/dev/null` as the device. The fake device has 4MB
+    of flash with the test firmware written at the bootloader offset."""
+    esp = FakeESPTool("/dev/null")
+    data = firmwarefile.read_bytes()
+    esp.flash[BOOTLOADER_OFFSET : BOOTLOADER_OFFSET + len(data)] = data
+    monkeypatch.setattr(esptool_io, "get_esptool", lambda *args, **kwargs: esp)
+    return esp
+
+
 @pytest.fixture(scope="session")
 def device() -> Path | None:
     """Fixture to produce an initialised ESP32 device (session scope).
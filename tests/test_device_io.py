@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import esptool
+import pytest
+
+import mp_image_tool_esp32
+from mp_image_tool_esp32.esptool_io import change_baudrate
+from mp_image_tool_esp32.firmware_fileio import FirmwareDeviceIO
+
+from .conftest import FakeESPTool
+
+# These tests use a fake esptool backend (see `FakeESPTool` in conftest.py) to
+# check which flash operations are sent to the device.
+
+PHY_INIT_OFFSET = 0xF_000  # Offset of the phy_init partition on the flash
+
+
+def test_held_writes_batched(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    for pos, fill in ((0x9_000, b"\x01"), (0xA_000, b"\x02"), (0xC_000, b"\x03")):
+        f.seek(pos)
+        f.write(fill * 0x1_000)
+    assert fake_device.ops("write") == []  # Small writes are held back
+    f.close()
+    # Contiguous writes are merged: all regions are sent in one write command
+    assert fake_device.ops("write") == [
+        ("write", [(0x9_000, 0x2_000), (0xC_000, 0x1_000)])
+    ]
+    flash = fake_device.flash
+    assert flash[0x9_000:0xB_000] == b"\x01" * 0x1_000 + b"\x02" * 0x1_000
+    assert flash[0xC_000:0xD_000] == b"\x03" * 0x1_000
+
+
+def test_held_writes_flushed_on_error(fake_device: FakeESPTool):
+    Path("phy_init.bin").write_bytes(b"\x01" * 0x1_000)
+    args = ["/dev/null", "--write", "phy_init=phy_init.bin", "--ota-update", "x.bin"]
+    assert mp_image_tool_esp32.main(args) == 1  # Fails: no OTA partitions
+    assert fake_device.flash[PHY_INIT_OFFSET : PHY_INIT_OFFSET + 0x1_000] == (
+        b"\x01" * 0x1_000
+    )
+
+
+def test_unchanged_write_skipped(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    data = f.pread(PHY_INIT_OFFSET, 0x1_000)  # Block is now in the read cache
+    f.seek(PHY_INIT_OFFSET)
+    assert f.write(data) == len(data)
+    f.close()
+    assert fake_device.ops("write", "md5") == []
+
+
+def test_large_write_not_held(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    f.seek(0x200_000)
+    f.write(b"\x01" * f.WRITE_BUFFER)  # Streamed chunks are written directly
+    assert fake_device.ops("write", "md5") == [("write", [(0x200_000, f.WRITE_BUFFER)])]
+    f.close()
+
+
+def test_unaligned_write_fails(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    f.seek(PHY_INIT_OFFSET + 0x10)
+    with pytest.raises(ValueError):  # Raised by write(), not later by close()
+        f.write(b"\x01" * 0x10)
+    f.close()
+    assert fake_device.ops("write") == []
+
+
+@pytest.mark.parametrize("md5", [True, False])
+def test_uncached_write_md5(fake_device: FakeESPTool, md5: bool):
+    fake_device.md5 = md5  # Can the device calculate the MD5 digest?
+    data = bytes(fake_device.flash[PHY_INIT_OFFSET : PHY_INIT_OFFSET + 0x1_000])
+    f = FirmwareDeviceIO("/dev/null")
+    f.seek(PHY_INIT_OFFSET)
+    f.write(data)  # The block is not in the read cache
+    f.close()
+    if md5:  # Unchanged data is detected on the device and not written
+        assert fake_device.ops("write", "md5") == [("md5", PHY_INIT_OFFSET, 0x1_000)]
+    else:  # Without a device MD5, the data is written without reading it first
+        assert fake_device.ops("write", "md5") == [
+            ("write", [(PHY_INIT_OFFSET, 0x1_000)])
+        ]
+    assert fake_device.ops("read") == [("read", 0x1_000, 0x1_000)]  # Bootloader
+
+
+def test_small_erase(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    f.seek(PHY_INIT_OFFSET)
+    f.erase(0x1_000)  # A single native erase
+    assert fake_device.ops("erase", "write", "md5") == [
+        ("erase", PHY_INIT_OFFSET, 0x1_000)
+    ]
+    f.pread(PHY_INIT_OFFSET, 0x1_000)  # The erased block is now in the read cache
+    f.seek(PHY_INIT_OFFSET)
+    f.erase(0x1_000)  # Skipped: the block is already erased
+    f.close()
+    assert len(fake_device.ops("erase", "write", "md5")) == 1
+
+
+def test_only_changed_blocks_written(fake_device: FakeESPTool):
+    f = FirmwareDeviceIO("/dev/null")
+    data = bytearray(f.pread(0x9_000, 0x4_000))  # Four blocks in the read cache
+    data[0x1_000:0x1_010] = b"\x01" * 0x10  # Change the second and third blocks
+    data[0x2_FF0:0x3_000] = b"\x02" * 0x10
+    f.seek(0x9_000)
+    f.write(data)
+    f.close()
+    assert fake_device.ops("write", "md5") == [("write", [(0xA_000, 0x2_000)])]
+    assert fake_device.flash[0x9_000:0xD_000] == data
+
+
+class FakeLoader:
+    """A fake esptool `ESPLoader` connection which fails at rates over
+    `max_baud`. Records each baudrate change in `rates`."""
+
+    def __init__(self, max_baud: int) -> None:
+        self._port = SimpleNamespace(baudrate=115200)
+        self.max_baud = max_baud
+        self.rates: list[int] = []
+
+    def change_baud(self, baud: int) -> None:
+        self.rates.append(baud)
+        self._port.baudrate = baud
+
+    def flash_id(self) -> None:
+        if self._port.baudrate > self.max_baud:
+            raise esptool.FatalError("Timed out waiting for packet header")
+
+
+@pytest.mark.parametrize(
+    "baud, expected", [(115200, 115200), (460800, 460800), (921600, None)]
+)
+def test_change_baudrate(baud: int, expected: int | None):
+    esp: Any = FakeLoader(max_baud=460800)
+    if expected is None:
+        with pytest.raises(ValueError, match=f"at {baud} baud"):
+            change_baudrate(esp, baud)
+    else:
+        assert change_baudrate(esp, baud) == expected
+    # Only one change is tried: a failed rate can't be used to try another
+    assert esp.rates == ([] if baud == 115200 else [baud])
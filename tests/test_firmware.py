@@ -6,6 +6,9 @@ from pathlib import Path
 import pytest
 import yaml
 
+from mp_image_tool_esp32.firmware import Firmware, is_device
+from mp_image_tool_esp32.image_header import ImageHeader
+
 from .conftest import assert_output, log_messages, mpi_run, options
 
 rootdir = Path(__file__).parent.parent
@@ -164,3 +167,52 @@ def test_read_write(firmware: Path):
     sha3 = hashlib.sha256(firmware.read_bytes()).hexdigest()
     assert sha1 == sha2
     assert sha1 == sha3
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("/dev/ttyUSB0", True),
+        ("COM3", True),
+        ("com10", True),
+        ("COMPILED.bin", False),
+        ("COM", False),
+        ("firmware.bin", False),
+    ],
+)
+def test_is_device(name: str, expected: bool):
+    assert is_device(name) == expected
+
+
+@pytest.mark.parametrize("chunksize", [7, 4096, 0x10000])
+def test_check_image_hash_stream(bootloader: bytes, app_image: bytes, chunksize: int):
+    for image in (bootloader, app_image):
+        header = ImageHeader.from_bytes(image)
+        chunks = (image[i : i + chunksize] for i in range(0, len(image), chunksize))
+        assert header.check_image_hash_stream(chunks) == header.check_image_hash(image)
+        with pytest.raises(ValueError):  # Image is truncated before the end
+            header.check_image_hash_stream(iter([image[: len(image) // 2]]))
+
+
+def test_erase_regions(firmwarefile: Path, monkeypatch: pytest.MonkeyPatch):
+    local = Path("erase.bin")
+    data = bytearray(firmwarefile.read_bytes())
+    data[0x8000:0xE000] = b"\x5a" * 0x6000  # Fill nvs (at 0x9000 on flash)
+    local.write_bytes(data)
+    image = Firmware(str(local))
+    erase, erased = image.file.erase, []
+
+    def log_erase(size: int) -> None:
+        erased.append((image.file.tell(), size))
+        erase(size)
+
+    monkeypatch.setattr(image.file, "erase", log_erase)
+    # Overlapping and adjacent regions are merged into a single erase
+    image.erase_regions([(0xD000, 0x1000), (0xA000, 0x1000), (0x9000, 0x1800)])
+    image.file.close()
+    assert erased == [(0x9000, 0x2000), (0xD000, 0x1000)]
+    output = local.read_bytes()  # Firmware file starts at 0x1000 on the flash
+    assert output[0x8000:0xA000] == b"\xff" * 0x2000
+    assert output[0xA000:0xC000] == b"\x5a" * 0x2000
+    assert output[0xC000:0xD000] == b"\xff" * 0x1000
+    assert output[0xD000:0xE000] == b"\x5a" * 0x1000
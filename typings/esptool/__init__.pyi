@@ -6,6 +6,9 @@ import serial
 class StubFlasher: ...
 
 
+class FatalError(RuntimeError): ...
+
+
 class ESPLoader:
     CHIP_NAME: str
     _port: serial.Serial
@@ -19,6 +22,9 @@ class ESPLoader:
     def erase_region(self, offset: int, size: int) -> None: ...
     def run_stub(self, stub: StubFlasher | None = None) -> "ESPLoader": ...
     def hard_reset(self) -> None: ...
+    def change_baud(self, baud: int) -> None: ...
+    def flash_id(self) -> int: ...
+    def flash_md5sum(self, addr: int, size: int) -> str: ...
 
 
 def main(argv: Sequence[str], esp: ESPLoader | None) -> None: ...